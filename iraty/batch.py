@@ -0,0 +1,146 @@
+"""
+Batch mode: renders a stream of documents read from stdin, with the
+same (warm) pipeline, and writes the results to stdout, in order.
+
+Two input formats are accepted:
+
+- JSON lines (the default): one JSON object per line, with the YAML text in *content*
+  (or the path of a document in *path*), an optional *id*, and optional
+  *options* (*output*: html, cid or ipfs). A JSON object is written
+  back for each document:
+
+  {"id": 1, "path": "site/index.yaml", "options": {"output": "cid"}}
+  {"id": 1, "cid": "bafkrei...", "ms": 3.1}
+
+- NUL-separated YAML documents (with null=True, -0 on the command
+  line): the HTML documents (or the CIDs) are
+  written back, separated by NUL bytes. Failed documents are written
+  empty (the error goes to stderr).
+"""
+
+import collections
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .server import render_request
+
+
+def read_jsonl(fd):
+    for line in fd:
+        if line.strip():
+            yield line
+
+
+def read_nul(fd, chunk_size: int = 65536):
+    buf = b''
+
+    while True:
+        chunk = fd.read(chunk_size)
+        if not chunk:
+            break
+
+        buf += chunk
+        *docs, buf = buf.split(b'\0')
+
+        for doc in docs:
+            yield doc
+
+    if buf.strip():
+        yield buf
+
+
+def ordered(pool, fn, items, ahead: int):
+    """
+    Like pool.map(), but consumes items lazily (at most ahead items are
+    queued) and yields the results as soon as they're available, in order
+    """
+    pending = collections.deque()
+
+    for item in items:
+        pending.append(pool.submit(fn, item))
+
+        if len(pending) >= ahead:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+
+class BatchRenderer:
+    def __init__(self, ira, output: str = 'html'):
+        self.ira = ira
+        self.output = output
+
+    def render(self, req: dict):
+        """
+        Render a document, returns the result (HTML or CID)
+        """
+        return render_request(self.ira, req, output=self.output, paths=True)
+
+    def process(self, item):
+        """
+        Process a JSON line (str), or a YAML document (bytes)
+        """
+        start = time.monotonic()
+        resp = {}
+
+        try:
+            if isinstance(item, bytes):
+                req = {'content': item.decode()}
+            else:
+                req = json.loads(item)
+                assert isinstance(req, dict), 'Request must be a JSON object'
+                resp['id'] = req.get('id')
+
+            key, value = self.render(req)
+            resp[key] = value
+        except Exception as err:
+            resp['error'] = str(err) if str(err) else type(err).__name__
+            self.ira.metrics.error('batch')
+
+        elapsed = time.monotonic() - start
+        resp['ms'] = round(elapsed * 1000, 2)
+        self.ira.metrics.observe('request_duration_seconds', elapsed)
+
+        return resp
+
+
+def batch(ira, fdin=None, fdout=None, output: str = 'html', jobs: int = 0,
+          null: bool = False):
+    """
+    Render the documents read from fdin (binary), writing the results
+    to fdout (binary). The input is JSON lines, or NUL-separated YAML
+    documents if null is True. Returns 1 if a document failed, 0
+    otherwise.
+    """
+    fdin = fdin if fdin else sys.stdin.buffer
+    fdout = fdout if fdout else sys.stdout.buffer
+    workers = jobs if jobs else os.cpu_count()
+    renderer = BatchRenderer(ira, output=output)
+    rc = 0
+
+    jsonl = not null
+    items = read_jsonl(io.TextIOWrapper(fdin, encoding='utf-8')) if \
+        jsonl else read_nul(fdin)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for idx, resp in enumerate(ordered(pool, renderer.process, items,
+                                           ahead=workers * 2)):
+            if 'error' in resp:
+                rc = 1
+                print(f"Document {idx + 1}: {resp['error']}",
+                      file=sys.stderr)
+
+            if jsonl:
+                fdout.write(json.dumps(resp).encode() + b'\n')
+            else:
+                value = resp.get('html', resp.get('cid', ''))
+                fdout.write(value.encode() + b'\0')
+
+            fdout.flush()
+
+    return rc
@@ -0,0 +1,297 @@
+"""
+Content-addressed build cache, shared between builds (and machines).
+
+Rendered pages are stored under a key computed from everything the
+page's HTML depends on: its source, its layout, the site options (theme,
+languages, fingerprints), the Jinja templates, the code and the package
+data of iraty (themes, assets, templates) and the versions of the
+libraries producing the HTML.
+The files the page depends on (includes, templates) are only known once
+it's rendered, so they are stored in a dependency record (under the
+page key), and the HTML is stored under a key including their digests.
+
+Pages using resolvers whose results can change (dtnow_iso, http
+resources, IPNS paths) are not cached. The results of the resolvers
+fetching content-addressed resources (/ipfs/ paths) are cached too.
+
+The store is a directory (local or shared), or an HTTP server (GET and
+PUT of the keys, relative to a base URL).
+"""
+
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+from pathlib import Path
+from urllib.parse import urlparse
+
+import pkg_resources
+import requests
+
+from .fsutil import atomic_write
+from .fsutil import file_digest
+from . import httpclient
+
+
+cache_format = 1
+
+# Resolvers fetching resources, and the position of the URL argument
+fetch_resolvers = {
+    'cat': 0,
+    'cat64': 0,
+    'csum_hex': 1
+}
+
+# Distributions whose version can change the output
+output_dependencies = [
+    'domonic',
+    'iso639-lang',
+    'Jinja2',
+    'Markdown',
+    'omegaconf',
+    'PyYAML'
+]
+
+cid_re = re.compile(r'^(Qm[1-9A-HJ-NP-Za-km-z]{44}|b[a-z2-7]{58,})(/|$)')
+
+
+def digest(*parts):
+    h = hashlib.sha256()
+
+    for part in parts:
+        data = part if isinstance(part, bytes) else str(part).encode()
+        h.update(len(data).to_bytes(8, 'big'))
+        h.update(data)
+
+    return h.hexdigest()
+
+
+def dependency_versions():
+    versions = []
+
+    for name in output_dependencies:
+        try:
+            version = pkg_resources.get_distribution(name).version
+        except pkg_resources.DistributionNotFound:
+            version = None
+
+        versions.append(f'{name}=={version}')
+
+    return versions
+
+
+def code_digest():
+    """
+    Digest of the code of iraty (the python modules and the package
+    data: themes, assets, templates) and of the versions of the
+    libraries it uses to render the pages
+    """
+    pkgdir = Path(os.path.dirname(__file__))
+    files = sorted(p for p in pkgdir.rglob('*')
+                   if p.is_file() and '__pycache__' not in p.parts)
+
+    return digest(*dependency_versions(), *[
+        part for p in files
+        for part in (str(p.relative_to(pkgdir)), p.read_bytes())
+    ])
+
+
+def content_addressed(url: str):
+    """
+    True if url refers to immutable (content-addressed) content
+    """
+    if not isinstance(url, str):
+        return False
+
+    scheme = urlparse(url).scheme
+
+    if scheme == 'ipfs':
+        return True
+    elif not scheme:
+        return url.startswith('/ipfs/') or cid_re.match(url) is not None
+
+    return False
+
+
+class DirectoryStore:
+    def __init__(self, path: Path):
+        self.root = path
+
+    def path(self, key: str):
+        return self.root.joinpath(key[:2], key)
+
+    def get(self, key: str):
+        try:
+            return self.path(key).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, data: bytes):
+        dest = self.path(key)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write(dest, data)
+
+
+class HttpStore:
+    def __init__(self, url: str):
+        self.url = url.rstrip('/')
+
+    def get(self, key: str):
+        # Streamed, the size of the entries is limited (--http-max-size)
+        try:
+            return httpclient.get_client().get(f'{self.url}/{key}')
+        except requests.HTTPError as err:
+            if err.response is not None and err.response.status_code == 404:
+                return None
+
+            raise
+
+    def put(self, key: str, data: bytes):
+        client = httpclient.get_client()
+        resp = client.session.put(f'{self.url}/{key}', data=data,
+                                  timeout=client.timeout)
+        resp.raise_for_status()
+
+
+def open_store(location: str):
+    if urlparse(location).scheme in ['http', 'https']:
+        return HttpStore(location)
+
+    return DirectoryStore(Path(location))
+
+
+class BuildCache:
+    """
+    Cache of rendered pages and resolver results. salt identifies the
+    site options (anything the pages depend on other than their
+    sources). root is the root of the website (for includes).
+    """
+
+    def __init__(self, store, salt: str, root: Path, metrics=None):
+        self.store = store
+        self.salt = salt
+        self.root = root
+        self.metrics = metrics
+        self.code = code_digest()
+        self.failed = False
+        self.lock = threading.Lock()
+        self.lookups, self.hits = 0, 0
+
+    def get(self, key: str):
+        if self.failed:
+            return None
+
+        try:
+            return self.store.get(key)
+        except Exception as err:
+            self.disable(err)
+
+    def put(self, key: str, data: bytes):
+        if self.failed:
+            return
+
+        try:
+            self.store.put(key, data)
+        except Exception as err:
+            self.disable(err)
+
+    def disable(self, err):
+        # Builds work without the cache
+        with self.lock:
+            if not self.failed:
+                print(f'Build cache error, disabled: {err}', file=sys.stderr)
+                self.failed = True
+
+    def page_key(self, relp: str, fp: Path, layoutp: Path = None):
+        return digest(cache_format, self.code, self.salt, relp,
+                      fp.read_bytes(),
+                      layoutp.read_bytes() if layoutp else b'')
+
+    def dependencies(self, calls, kinds: dict):
+        """
+        Returns the dependencies ([kind, path] lists) of a page from the
+        resolver calls and the templates used to render it, or None if
+        the page can't be cached
+        """
+        deps = []
+
+        for name, args in calls:
+            if name == 'include':
+                deps.append(['include', str(args[0])])
+            elif name == 'template':
+                deps.append(['template', str(args[0])])
+            elif name in fetch_resolvers and \
+                    content_addressed(args[fetch_resolvers[name]]):
+                continue
+            elif kinds.get(name) != 'pure':
+                return None
+
+        return sorted(set(tuple(d) for d in deps))
+
+    def dependency_digest(self, kind: str, path: str):
+        fp = self.root.joinpath(path) if kind == 'include' else Path(path)
+
+        try:
+            return file_digest(fp)
+        except OSError:
+            return None
+
+    def versions_key(self, key: str, deps: list):
+        return digest(key, *[
+            f'{kind}:{path}:{self.dependency_digest(kind, path)}'
+            for kind, path in deps
+        ])
+
+    def lookup(self, key: str):
+        """
+        Returns the HTML of the page key, or None
+        """
+        html = None
+        record = self.get(f'{key}-deps')
+
+        if record is not None:
+            deps = json.loads(record)
+            html = self.get(self.versions_key(key, deps))
+
+        self.lookups += 1
+        self.hits += 1 if html is not None else 0
+
+        if self.metrics:
+            self.metrics.cache('build_page', html is not None)
+
+        return html
+
+    def store_page(self, key: str, deps: list, html: bytes):
+        self.put(f'{key}-deps', json.dumps(deps).encode())
+        self.put(self.versions_key(key, deps), html)
+
+    def result_key(self, name: str, args):
+        if name not in fetch_resolvers or \
+                not content_addressed(args[fetch_resolvers[name]]):
+            return None
+
+        return digest(cache_format, 'resolver', name, repr(args))
+
+    def result(self, name: str, args):
+        """
+        Returns (True, result) if the result of this resolver call is
+        cached, (False, None) otherwise
+        """
+        key = self.result_key(name, args)
+        if not key:
+            return False, None
+
+        data = self.get(key)
+
+        if self.metrics:
+            self.metrics.cache('build_resolver', data is not None)
+
+        return (True, json.loads(data)) if data is not None else (False, None)
+
+    def store_result(self, name: str, args, value):
+        key = self.result_key(name, args)
+
+        if key and isinstance(value, str):
+            self.put(key, json.dumps(value).encode())
@@ -0,0 +1,75 @@
+import json
+import os
+import sys
+import threading
+from pathlib import Path
+
+from . import appdirs
+
+
+def cache_dir() -> Path:
+    path = Path(appdirs.user_cache_dir('iraty'))
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def file_stamp(path: Path):
+    """
+    Return the (mtime_ns, size) stamp of a file, used to detect changes
+    """
+    st = path.stat()
+    return st.st_mtime_ns, st.st_size
+
+
+class JsonCache:
+    """
+    A dictionary persisted as a JSON file in the user's cache directory
+    """
+
+    def __init__(self, name: str, path: Path = None):
+        self.path = path if path else cache_dir().joinpath(f'{name}.json')
+        self.data = {}
+        self.dirty = False
+
+    def load(self):
+        try:
+            with open(self.path, 'rt') as fd:
+                data = json.load(fd)
+
+            if isinstance(data, dict):
+                self.data = data
+        except FileNotFoundError:
+            pass
+        except Exception as err:
+            print(f'Ignoring invalid cache {self.path}: {err}',
+                  file=sys.stderr)
+
+        return self
+
+    def get(self, key: str, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key: str, value):
+        self.data[key] = value
+        self.dirty = True
+
+    def pop(self, key: str):
+        if key in self.data:
+            del self.data[key]
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+
+        tmp = self.path.with_name(f'.{self.path.name}.{os.getpid()}.'
+                                  f'{threading.get_ident()}.tmp')
+
+        try:
+            with open(tmp, 'wt') as fd:
+                json.dump(self.data, fd)
+
+            os.replace(tmp, self.path)
+            self.dirty = False
+        except Exception as err:
+            print(f'Cannot save cache {self.path}: {err}', file=sys.stderr)
@@ -0,0 +1,278 @@
+"""
+CARv1 (Content Addressable aRchive) writer and reader
+"""
+
+import mmap
+import os
+from pathlib import Path
+
+from .cache import JsonCache
+from .fsutil import temp_file
+from .unixfs import DagBuilder
+from .unixfs import UnsupportedDag
+from .unixfs import cid_codec
+from .unixfs import cid_str
+from .unixfs import codec_dagpb
+from .unixfs import codec_raw
+from .unixfs import decode_pb_node
+from .unixfs import decode_unixfs_data
+from .unixfs import read_varint
+from .unixfs import t_directory
+from .unixfs import t_file
+from .unixfs import t_hamt_shard
+from .unixfs import t_raw
+from .unixfs import varint
+
+
+# Size of a CIDv1 (dag-pb or raw, sha2-256)
+cid_length = 36
+
+
+def car_header(root: bytes):
+    """
+    The dag-cbor encoded header: {'roots': [root], 'version': 1}
+    """
+    # CIDs are encoded as tag 42, with a 0x00 (identity multibase) prefix
+    cid = b'\xd8\x2a\x58' + bytes([len(root) + 1]) + b'\x00' + root
+    header = b'\xa2\x65roots\x81' + cid + b'\x67version\x01'
+    return varint(len(header)) + header
+
+
+class CarWriter:
+    """
+    Streams the blocks of a DAG to a CAR file. The root is not known
+    until the DAG is complete, so the header is written with a
+    placeholder root, which is patched at the end.
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.seen = set()
+        self.blocks = 0
+        self.fd.write(car_header(bytes(cid_length)))
+
+    def write_block(self, cid: bytes, data: bytes):
+        if cid in self.seen:
+            return
+
+        self.seen.add(cid)
+        self.blocks += 1
+        self.fd.write(varint(len(cid) + len(data)))
+        self.fd.write(cid)
+        self.fd.write(data)
+
+    def finish(self, root: bytes):
+        assert len(root) == cid_length
+        self.fd.seek(0)
+        self.fd.write(car_header(root))
+        self.fd.seek(0, os.SEEK_END)
+
+
+def export_car(path: Path, dest: Path):
+    """
+    Write the UnixFS DAG of path as a CAR file (dest is replaced
+    atomically). Returns the root CID.
+    """
+    cache = JsonCache('cids').load()
+    tmp = temp_file(dest)
+
+    try:
+        with tmp:
+            writer = CarWriter(tmp)
+            link = DagBuilder(sink=writer.write_block,
+                              cache=cache).add_path(path)
+            writer.finish(link.cid)
+
+        os.replace(tmp.name, str(dest))
+    except BaseException:
+        os.unlink(tmp.name)
+        raise
+    finally:
+        cache.save()
+
+    return cid_str(link.cid)
+
+
+class InvalidCar(Exception):
+    pass
+
+
+def cbor_item(buf, offset: int):
+    """
+    Decode the (dag-cbor) item at offset, returns the item and the
+    offset of the next byte. Only what's needed for CAR headers is
+    supported: integers, strings, arrays, maps, and CIDs (tag 42).
+    """
+    ib = buf[offset]
+    major, info = ib >> 5, ib & 0x1f
+    offset += 1
+
+    if info < 24:
+        arg = info
+    elif info in [24, 25, 26, 27]:
+        length = 1 << (info - 24)
+        arg = int.from_bytes(buf[offset:offset + length], 'big')
+        offset += length
+    else:
+        raise InvalidCar(f'Unsupported CBOR item: {ib:#x}')
+
+    if major == 0:
+        return arg, offset
+    elif major == 1:
+        return -1 - arg, offset
+    elif major in [2, 3]:
+        data = bytes(buf[offset:offset + arg])
+        return data if major == 2 else data.decode(), offset + arg
+    elif major == 4:
+        items = []
+        for idx in range(arg):
+            item, offset = cbor_item(buf, offset)
+            items.append(item)
+        return items, offset
+    elif major == 5:
+        items = {}
+        for idx in range(arg):
+            key, offset = cbor_item(buf, offset)
+            items[key], offset = cbor_item(buf, offset)
+        return items, offset
+    elif major == 6 and arg == 42:
+        cid, offset = cbor_item(buf, offset)
+        # Strip the identity multibase prefix
+        return cid[1:], offset
+
+    raise InvalidCar(f'Unsupported CBOR item: {ib:#x}')
+
+
+class CarArchive:
+    """
+    Read-only access to the blocks of a CARv1 file, and to the UnixFS
+    files and directories it contains.
+
+    The archive is memory-mapped, and indexed once (the index maps each
+    CID to the position of its block in the file), only the section
+    headers are read.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.fd = open(str(path), 'rb')
+
+        try:
+            self.map = mmap.mmap(self.fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise InvalidCar(f'{path}: empty file')
+
+        self.blocks = {}
+        self.roots = []
+        self.index()
+
+    def close(self):
+        self.map.close()
+        self.fd.close()
+
+    def index(self):
+        buf, size = self.map, len(self.map)
+
+        try:
+            length, offset = read_varint(buf, 0)
+            header, _end = cbor_item(buf, offset)
+            offset += length
+        except (IndexError, UnicodeDecodeError) as err:
+            raise InvalidCar(f'{self.path}: invalid header ({err})')
+
+        if not isinstance(header, dict) or header.get('version') != 1:
+            raise InvalidCar(f'{self.path}: not a CARv1 file')
+
+        self.roots = header.get('roots', [])
+
+        while offset < size:
+            length, start = read_varint(buf, offset)
+            end = start + length
+
+            if end > size:
+                raise InvalidCar(f'{self.path}: truncated block at {offset}')
+
+            if buf[start] == 0x12 and buf[start + 1] == 0x20:
+                # CIDv0
+                cidend = start + 34
+            else:
+                _v, pos = read_varint(buf, start)
+                _codec, pos = read_varint(buf, pos)
+                _mh, pos = read_varint(buf, pos)
+                mhlen, pos = read_varint(buf, pos)
+                cidend = pos + mhlen
+
+            self.blocks[bytes(buf[start:cidend])] = (cidend, end)
+            offset = end
+
+    def block_range(self, cid: bytes):
+        try:
+            return self.blocks[cid]
+        except KeyError:
+            raise InvalidCar(f'Block not found: {cid_str(cid)}')
+
+    def node(self, cid: bytes):
+        """
+        Returns the UnixFS type of the node cid, its links and the
+        (start, end) positions of its file data
+        """
+        start, end = self.block_range(cid)
+
+        if cid_codec(cid) == codec_raw:
+            return t_raw, [], (start, end)
+        elif cid_codec(cid) != codec_dagpb:
+            raise UnsupportedDag(f'{cid_str(cid)}: unsupported codec')
+
+        links, data = decode_pb_node(self.map, start, end)
+        if not data:
+            raise UnsupportedDag(f'{cid_str(cid)}: not a UnixFS node')
+
+        dtype, fdata, _size = decode_unixfs_data(self.map, *data)
+        return dtype, links, fdata
+
+    def resolve(self, names: list, root: bytes = None):
+        """
+        Resolve a path (list of names) from the root, returns the CID,
+        the UnixFS type and the links of the node
+        """
+        cid = root if root else self.roots[0]
+        dtype, links, _data = self.node(cid)
+
+        for name in names:
+            if dtype == t_hamt_shard:
+                raise UnsupportedDag('HAMT-sharded directories are not '
+                                     'supported')
+            elif dtype != t_directory:
+                return None, None, None
+
+            for lcid, lname, _tsize in links:
+                if lname == name:
+                    cid = lcid
+                    break
+            else:
+                return None, None, None
+
+            dtype, links, _data = self.node(cid)
+
+        return cid, dtype, links
+
+    def file_segments(self, cid: bytes):
+        """
+        Returns the (position, length) segments of the archive making
+        the contents of the file cid
+        """
+        segments = []
+        stack = [cid]
+
+        while stack:
+            dtype, links, data = self.node(stack.pop())
+
+            if dtype not in [t_raw, t_file]:
+                raise UnsupportedDag(f'{cid_str(cid)}: not a file')
+
+            if data and data[1] > data[0]:
+                segments.append((data[0], data[1] - data[0]))
+
+            stack.extend(reversed([lcid for lcid, _n, _t in links]))
+
+        return segments
@@ -0,0 +1,244 @@
+import os
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urlparse
+
+from jinja2 import TemplateNotFound
+from jinja2 import TemplateSyntaxError
+
+from . import i18n
+from .omega import load_document
+from . import resolvers
+
+
+dots = ['.' * x for x in range(1, 4)]
+auto_attrs = ['_href_auto', '_src_auto']
+tag_re = re.compile(r'^[A-Za-z][A-Za-z0-9-]*$')
+
+
+def is_scalar(obj):
+    return isinstance(obj, (str, int, float)) and not isinstance(obj, bool)
+
+
+class PageCheck:
+    """
+    Checks the structure of a resolved page (as it will be seen by
+    convert())
+    """
+
+    def __init__(self, path: Path, root: Path, ctx, assets=None):
+        self.path = path
+        self.root = root
+        self.ctx = ctx
+        self.jenv = ctx.jenv
+        self.assets = assets if assets else []
+        self.problems = []
+        self.blocks = []
+
+    def problem(self, where: str, msg: str):
+        self.problems.append(f'{where}: {msg}' if where else msg)
+
+    def load(self):
+        try:
+            with open(self.path, 'rt') as fd:
+                foc = load_document(fd)
+
+            with self.ctx.activate():
+                return resolvers.resolve(foc)
+        except Exception as err:
+            self.problem('', str(err).splitlines()[0] if str(err) else
+                         type(err).__name__)
+
+    def auto_target_exists(self, value: str):
+        relp = value.split('#')[0].split('?')[0]
+        if not relp or relp in self.assets:
+            return True
+
+        # Relative to the page's directory
+        target = self.path.parent.joinpath(relp)
+        if relp.endswith('/'):
+            target = target.joinpath('index.html')
+
+        if target.exists():
+            return True
+
+        if target.suffix == '.html':
+            # Generated from a YAML source (possibly per-language)
+            stem = target.with_suffix('')
+            for cand in [f'{stem.name}.yaml', f'{stem.name}.yml']:
+                if stem.parent.joinpath(cand).is_file():
+                    return True
+
+            if stem.parent.is_dir():
+                for entry in os.listdir(stem.parent):
+                    if i18n.language_target(Path(entry))[0] == stem.name:
+                        return True
+
+        return False
+
+    def check_jinja(self, where: str, value):
+        try:
+            if isinstance(value, str):
+                self.jenv.parse(value)
+            elif isinstance(value, dict):
+                tpath, template = value.get('from'), value.get('template')
+                args = value.get('with', {})
+
+                if isinstance(tpath, str):
+                    source, _f, _u = self.jenv.loader.get_source(
+                        self.jenv, tpath)
+                    self.jenv.parse(source)
+                elif isinstance(template, str):
+                    self.jenv.parse(template)
+                else:
+                    self.problem(where, "jinja needs a 'from' or "
+                                 "'template' string")
+
+                if not isinstance(args, dict):
+                    self.problem(where, "jinja 'with' must be a mapping")
+            else:
+                self.problem(where, 'jinja must be a string or a mapping')
+        except TemplateNotFound as err:
+            self.problem(where, f'jinja template not found: {err}')
+        except TemplateSyntaxError as err:
+            self.problem(where, f'jinja syntax error (line {err.lineno}): '
+                         f'{err.message}')
+
+    def check_toc(self, where: str, value):
+        if not isinstance(value, dict):
+            self.problem(where, 'toc must be a mapping (use the toc resolver)')
+            return
+
+        if value.get('_scope') != '.':
+            self.problem(where, f"unsupported toc scope: {value.get('_scope')}")
+
+        try:
+            depth = int(value.get('_depth', 0))
+            assert depth in range(0, 7)
+        except Exception:
+            self.problem(where, f"invalid toc depth: {value.get('_depth')} "
+                         "(should be between 0 and 6)")
+
+    def check(self, node, where=''):
+        if isinstance(node, dict):
+            for key, value in node.items():
+                kwhere = f'{where}/{key}'
+
+                if not isinstance(key, str):
+                    self.problem(kwhere, 'keys must be strings')
+                elif len(key) > 1 and key.startswith('_'):
+                    if not is_scalar(value):
+                        self.problem(kwhere, 'attribute values must be '
+                                     'strings or numbers')
+                    elif key in auto_attrs and isinstance(value, str) and \
+                            not urlparse(value).scheme and \
+                            not self.auto_target_exists(value):
+                        self.problem(kwhere, f'target does not exist: {value}')
+                elif key in dots:
+                    self.check(value, where=kwhere)
+                elif key == '_':
+                    if not isinstance(value, str):
+                        self.problem(kwhere, 'text contents must be a string')
+                elif key == 'jinja':
+                    self.check_jinja(kwhere, value)
+                elif key == 'toc':
+                    self.check_toc(kwhere, value)
+                else:
+                    if key.startswith('block_'):
+                        self.blocks.append(key)
+                    elif not tag_re.match(key):
+                        self.problem(kwhere, f'invalid tag name: {key}')
+
+                    self.check(value, where=kwhere)
+        elif isinstance(node, list):
+            for idx, subn in enumerate(node):
+                self.check(subn, where=f'{where}[{idx}]')
+
+    def run(self):
+        node = self.load()
+
+        if node is not None:
+            self.check(node)
+
+        return self
+
+
+def find_layouts(root: Path):
+    layouts = {}
+
+    for dirp, dirs, files in os.walk(root):
+        if '.layout.yaml' in files:
+            layouts[Path(dirp)] = Path(dirp).joinpath('.layout.yaml')
+
+    return layouts
+
+
+def closest_layout(fp: Path, root: Path, layouts: dict):
+    current = fp.parent
+
+    while True:
+        if current in layouts:
+            return layouts[current]
+
+        if current == root or current == current.parent:
+            return None
+
+        current = current.parent
+
+
+def check(input_path: Path, ctx, assets=None, jobs: int = 0):
+    """
+    Load and resolve every page (and layout) of a website, and check
+    their structure without rendering anything. All the problems are
+    reported at once.
+    """
+
+    if input_path.is_file():
+        root, pages = input_path.parent, [input_path]
+    else:
+        root, pages = input_path, []
+
+        for dirp, dirs, files in os.walk(input_path):
+            for file in files:
+                if not file.startswith('.') and \
+                        (file.endswith('.yaml') or file.endswith('.yml')):
+                    pages.append(Path(dirp).joinpath(file))
+
+    layouts = find_layouts(root) if input_path.is_dir() else {}
+    workers = jobs if jobs else os.cpu_count()
+
+    def run(path: Path):
+        return PageCheck(path, root, ctx, assets=assets).run()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        lchecks = dict(zip(layouts.values(),
+                           pool.map(run, layouts.values())))
+        pchecks = list(pool.map(run, sorted(pages)))
+
+    problems = 0
+
+    for lcheck in lchecks.values():
+        for msg in lcheck.problems:
+            print(f'({lcheck.path}): {msg}', file=sys.stderr)
+            problems += 1
+
+    for pcheck in pchecks:
+        layoutp = closest_layout(pcheck.path, root, layouts)
+        lblocks = lchecks[layoutp].blocks if layoutp else []
+
+        for blk in pcheck.blocks:
+            if not layoutp:
+                pcheck.problem(blk, 'block used but there is no layout')
+            elif blk not in lblocks:
+                pcheck.problem(blk, f'block is not declared in {layoutp}')
+
+        for msg in pcheck.problems:
+            print(f'({pcheck.path}): {msg}', file=sys.stderr)
+            problems += 1
+
+    print(f'{len(pchecks) + len(lchecks)} file(s) checked, '
+          f'{problems} problem(s) found', file=sys.stderr)
+
+    return 0 if problems == 0 else 2
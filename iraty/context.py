@@ -0,0 +1,101 @@
+import collections
+import copy
+import functools
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+import markdown
+from markdown.extensions.toc import TocExtension
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+
+_local = threading.local()
+
+
+class BuildContext:
+    """
+    The state a build depends on: IPFS client, root path (for includes),
+    template search paths, Jinja environment, Markdown converter, caches
+    and metrics. Builds with separate contexts can run concurrently.
+
+    The resolvers get the context of the build with current(), the
+    context is activated (for the current thread) with activate().
+    """
+
+    def __init__(self,
+                 ipfs_client=None,
+                 root_path: Path = None,
+                 search_paths: list = None,
+                 metrics=None):
+        self.ipfs_client = ipfs_client
+        self.root_path = root_path
+        self.search_paths = search_paths if search_paths else []
+        self.metrics = metrics
+
+        self.jenv = Environment(
+            loader=FileSystemLoader([str(p) for p in self.search_paths]),
+            autoescape=select_autoescape()
+        )
+
+        self.md = markdown.Markdown(extensions=[TocExtension(permalink=True)])
+        self.md_lock = threading.Lock()
+        self.md_convert = functools.lru_cache(maxsize=4096)(self._md_convert)
+
+        # Results of the build-constant resolvers
+        self.memo = collections.OrderedDict()
+        self.memo_lock = threading.Lock()
+
+        # Shared build cache (see buildcache), and the resolver calls
+        # recorded while rendering a page (when not None)
+        self.build_cache = None
+        self.calls = None
+
+        # Fixed build time (reproducible builds), or None
+        self.build_time = None
+
+    def fork(self):
+        """
+        Returns a context sharing this context's client, paths, Jinja
+        environment, Markdown converter and metrics, with its own
+        build-constant results
+        """
+        ctx = copy.copy(self)
+        ctx.memo = collections.OrderedDict()
+        ctx.memo_lock = threading.Lock()
+        ctx.calls = None
+        return ctx
+
+    def _md_convert(self, text: str):
+        """
+        Convert markdown to HTML, returning the HTML and the toc tokens.
+        The conversion only depends on the text, so results are cached.
+        """
+        with self.md_lock:
+            html = self.md.convert(text)
+            return html, self.md.toc_tokens
+
+    @contextmanager
+    def activate(self):
+        """
+        Make this context the current context (in this thread)
+        """
+        previous = getattr(_local, 'context', None)
+        _local.context = self
+
+        try:
+            yield self
+        finally:
+            _local.context = previous
+
+
+default_context = BuildContext()
+
+
+def current():
+    """
+    Returns the context of the build running in this thread (or the
+    default context)
+    """
+    ctx = getattr(_local, 'context', None)
+    return ctx if ctx is not None else default_context
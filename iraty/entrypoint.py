@@ -1,6 +1,5 @@
 import argparse
-
-from .iraty import iraty
+import sys
 
 
 def run():
@@ -48,6 +47,29 @@ def run():
         default=8000,
         help='TCP port for the HTTP service')
 
+    parser.add_argument(
+        '--lazy',
+        dest='lazy',
+        action='store_true',
+        default=False,
+        help='serve: start serving immediately, and render the pages on '
+             'demand (re-rendered when their source changes)')
+
+    parser.add_argument(
+        '--no-live-reload',
+        dest='live_reload',
+        action='store_false',
+        default=True,
+        help='serve --lazy: do not reload the pages in the browser when '
+             'they change')
+
+    parser.add_argument(
+        '--from-car',
+        dest='from_car',
+        default=None,
+        help='serve: serve the website contained in this CAR file, as it '
+             'would be published')
+
     parser.add_argument(
         '--ipns-name',
         dest='ipns_key_name',
@@ -88,7 +110,67 @@ def run():
         dest='purge',
         action='store_true',
         default=True,
-        help='Purge output directory before rendering')
+        help='Purge stale html/css files from the output directory')
+
+    parser.add_argument(
+        '--staged',
+        dest='staged',
+        action='store_true',
+        default=False,
+        help='Build into a staging directory, and swap it atomically with '
+             'the output directory (or the symlink it points to) at the end')
+
+    parser.add_argument(
+        '--shard',
+        dest='shard',
+        default=None,
+        help='Only render the pages of shard i out of N (i/N), and write a '
+             'shard manifest. The outputs of the N shards are combined with '
+             'the merge command')
+
+    parser.add_argument(
+        '--build-cache',
+        dest='build_cache',
+        default=None,
+        help='Shared build cache: a directory, or the URL of an HTTP store '
+             '(GET/PUT). Rendered pages and content-addressed resources '
+             'are reused from it')
+
+    parser.add_argument(
+        '--reproducible',
+        dest='reproducible',
+        action='store_true',
+        default=False,
+        help='Reproducible output: sorted traversal, fixed build time '
+             '(SOURCE_DATE_EPOCH or last git commit), sorted attributes. '
+             'Deploys are skipped when the site did not change')
+
+    parser.add_argument(
+        '--asset-mode',
+        dest='asset_mode',
+        choices=['auto', 'reflink', 'hardlink', 'copy'],
+        default='auto',
+        help='How assets are published to the output directory when it is '
+             'on the same filesystem (auto: reflink, or copy if '
+             'reflinks are not supported). Default: auto')
+
+    parser.add_argument(
+        '--fingerprint',
+        dest='fingerprint',
+        action='store_true',
+        default=False,
+        help='Rename assets with a content hash (name.<hash>.ext), rewrite '
+             'the references and write an asset manifest '
+             '(asset-manifest.json)')
+
+    parser.add_argument(
+        '-k',
+        '--keep-going',
+        dest='keep_going',
+        action='store_true',
+        default=False,
+        help='Keep rendering the other pages when a page fails (the '
+             'previous output of failed pages is kept, exit status is 3)')
 
     parser.add_argument(
         '-t',
@@ -119,10 +201,105 @@ def run():
         default=None,
         help='Use a specific remote pinning service (RPS)')
 
+    parser.add_argument(
+        '--force-add',
+        dest='force_add',
+        action='store_true',
+        default=False,
+        help='Always add the website to IPFS, even if the node already '
+             'has the locally computed root CID pinned')
+
+    parser.add_argument(
+        '--car',
+        dest='car_path',
+        default=None,
+        help='CAR file path for export-car (default: the output directory '
+             'path with a .car extension)')
+
+    parser.add_argument(
+        '--http-timeout',
+        dest='http_timeout',
+        type=float,
+        default=30,
+        help='Read timeout (in seconds) for HTTP(S) resources fetched by '
+             'the resolvers (default: 30)')
+
+    parser.add_argument(
+        '--http-max-size',
+        dest='http_max_size',
+        type=int,
+        default=64,
+        help='Maximum size (in MiB) of HTTP(S) resources fetched by the '
+             'resolvers (default: 64)')
+
+    parser.add_argument(
+        '--listen',
+        dest='listen',
+        default=None,
+        help='Socket for render-server: a Unix socket path, or host:port '
+             'for TCP (default: iraty-<uid>.sock in the temp directory)')
+
+    parser.add_argument(
+        '-0',
+        '--null',
+        dest='null_input',
+        action='store_true',
+        default=False,
+        help='batch: the input is YAML documents separated by NUL bytes '
+             '(instead of JSON lines)')
+
+    parser.add_argument(
+        '--batch-output',
+        dest='batch_output',
+        choices=['html', 'cid'],
+        default='html',
+        help='What batch writes for each document: html, or cid (the '
+             'CID of the HTML document, computed locally). With -i, the '
+             'documents are added to IPFS. Default: html')
+
+    parser.add_argument(
+        '--metrics',
+        dest='metrics_path',
+        default=None,
+        help='Write build metrics to this file')
+
+    parser.add_argument(
+        '--metrics-format',
+        dest='metrics_format',
+        choices=['jsonl', 'prometheus'],
+        default='jsonl',
+        help='Build metrics format: jsonl (appended), or prometheus '
+             '(text format, replaced). Default: jsonl')
+
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        dest='jobs',
+        type=int,
+        default=0,
+        help='Number of parallel jobs (default: number of CPUs)')
+
+    parser.add_argument(
+        '--no-lint-cache',
+        dest='lint_cache',
+        action='store_false',
+        default=True,
+        help='Lint all files, even those unchanged since the last clean run')
+
     parser.add_argument(
         nargs=1, default='run', dest='cmd',
-        help='Command: run, serve, list-resolvers, list-themes, node-config'
+        help='Command: run, serve, lint, check, cid, export-car, '
+             'render-server, batch, merge, list-resolvers, list-themes, '
+             'node-config'
     )
     parser.add_argument(nargs='*', dest='input')
 
-    return iraty(parser.parse_args())
+    args = parser.parse_args()
+
+    if args.cmd[0] == 'lint':
+        # Don't pay for the rendering/IPFS imports (pre-commit hook)
+        from .lint import lint
+        sys.exit(lint(args))
+
+    from .iraty import iraty
+    return iraty(args)
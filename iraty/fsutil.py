@@ -0,0 +1,313 @@
+import ctypes
+import ctypes.util
+import hashlib
+import os
+import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+
+# ioctl to clone a file (reflink) on btrfs/xfs/..
+FICLONE = 0x40049409
+
+asset_modes = ['auto', 'reflink', 'hardlink', 'copy']
+
+
+def temp_file(dest: Path):
+    """
+    Create a temporary file next to dest (opened for writing, in binary
+    mode). The file has the default mode of new files (the umask is
+    applied by the kernel).
+    """
+    while True:
+        try:
+            return open(str(dest.parent.joinpath(
+                f'.{dest.name}.{os.urandom(6).hex()}.tmp')), 'xb')
+        except FileExistsError:
+            continue
+
+
+def atomic_write(dest: Path, data: bytes):
+    """
+    Write data to dest atomically (via a temporary file in the same
+    directory and os.replace). Readers see either the old or the new file.
+    """
+    tmp = temp_file(dest)
+
+    try:
+        with tmp:
+            tmp.write(data)
+
+        os.replace(tmp.name, str(dest))
+    except BaseException:
+        os.unlink(tmp.name)
+        raise
+
+
+def atomic_copy(src: Path, dest: Path):
+    """
+    Copy the file src to dest atomically (dest can be a directory,
+    like with shutil.copy). Returns the destination path.
+    """
+    dest = Path(dest)
+    if dest.is_dir():
+        dest = dest.joinpath(Path(src).name)
+
+    tmp = temp_file(dest)
+
+    try:
+        with tmp:
+            with open(src, 'rb') as fsrc:
+                shutil.copyfileobj(fsrc, tmp)
+
+        shutil.copymode(str(src), tmp.name)
+        os.replace(tmp.name, str(dest))
+    except BaseException:
+        os.unlink(tmp.name)
+        raise
+
+    return dest
+
+
+def staging_directory(target: Path):
+    """
+    Create a (unique) staging directory next to target
+    """
+    while True:
+        staging = target.parent.joinpath(
+            f'.{target.name}.staging-{os.urandom(6).hex()}')
+
+        try:
+            os.mkdir(str(staging))
+            return staging
+        except FileExistsError:
+            continue
+
+
+def _renameat2_exchange(a: Path, b: Path):
+    if not sys.platform.startswith('linux'):
+        return False
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        renameat2 = libc.renameat2
+    except (OSError, AttributeError):
+        return False
+
+    ret = renameat2(AT_FDCWD, os.fsencode(str(a)),
+                    AT_FDCWD, os.fsencode(str(b)),
+                    RENAME_EXCHANGE)
+    return ret == 0
+
+
+def swap_directory(staging: Path, target: Path):
+    """
+    Put the staging directory in place of target.
+
+    If target is a symlink, a new symlink pointing to staging replaces it
+    atomically (and the previous directory is removed). Otherwise the two
+    directories are exchanged atomically (renameat2 on Linux, or with two
+    renames if not supported) and the previous output is removed.
+    """
+    if target.is_symlink():
+        previous = Path(os.path.realpath(str(target)))
+        link = target.with_name(f'.{target.name}.lnk-{os.getpid()}')
+
+        os.symlink(os.path.relpath(str(staging), str(target.parent)),
+                   str(link))
+        os.replace(str(link), str(target))
+
+        if previous.is_dir() and previous != Path(os.path.realpath(
+                str(staging))):
+            shutil.rmtree(str(previous), ignore_errors=True)
+    elif not target.exists():
+        os.rename(str(staging), str(target))
+    elif _renameat2_exchange(staging, target):
+        # staging now holds the previous output
+        shutil.rmtree(str(staging), ignore_errors=True)
+    else:
+        old = target.with_name(f'.{target.name}.old-{os.getpid()}')
+        os.rename(str(target), str(old))
+        os.rename(str(staging), str(target))
+        shutil.rmtree(str(old), ignore_errors=True)
+
+
+def file_digest(path: Path, algo: str = 'sha256'):
+    h = hashlib.new(algo)
+
+    with open(path, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(1024 * 1024), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def reflink(src: Path, dest: str):
+    """
+    Clone src to dest (copy-on-write). Raises OSError if the filesystem
+    does not support it.
+    """
+    if fcntl is None:
+        raise OSError('reflink is not supported')
+
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def copy_data(src: Path, dest: str):
+    """
+    Copy the contents of src to dest, using copy_file_range() if
+    available (in-kernel copy, which can be a server-side copy or a
+    reflink depending on the filesystem)
+    """
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdst:
+        if hasattr(os, 'copy_file_range'):
+            try:
+                remain = os.fstat(fsrc.fileno()).st_size
+
+                while remain > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(),
+                                                min(remain, 1 << 30))
+                    if copied == 0:
+                        break
+                    remain -= copied
+                else:
+                    return
+            except OSError:
+                pass
+
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+
+        shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+
+
+def unchanged(src: Path, sst, dest: Path):
+    """
+    Returns True if dest has the same contents as src (same inode,
+    same size and mtime, or same size and same hash)
+    """
+    try:
+        dst = os.stat(dest)
+    except FileNotFoundError:
+        return False
+
+    if (dst.st_dev, dst.st_ino) == (sst.st_dev, sst.st_ino):
+        return True
+
+    if dst.st_size != sst.st_size:
+        return False
+
+    if dst.st_mtime_ns == sst.st_mtime_ns:
+        return True
+
+    if file_digest(src) == file_digest(dest):
+        # Same contents, sync the mtime for the next build
+        os.utime(dest, ns=(sst.st_atime_ns, sst.st_mtime_ns))
+        return True
+
+    return False
+
+
+def publish_file(src: Path, dest: Path, mode: str = 'auto'):
+    """
+    Publish the file src (an asset) to dest, unless dest is already
+    up-to-date. When both files are on the same filesystem, the file is
+    reflinked (auto and reflink modes) or hard-linked (hardlink mode only)
+    instead of being copied. dest is replaced atomically.
+
+    Returns the action: 'unchanged', 'reflink', 'hardlink' or 'copy'
+    """
+    sst = os.stat(src)
+
+    if unchanged(src, sst, dest):
+        return 'unchanged'
+
+    actions = []
+    if os.stat(dest.parent).st_dev == sst.st_dev:
+        if mode in ['auto', 'reflink']:
+            actions.append('reflink')
+        if mode == 'hardlink':
+            # The output shares the inode of the source
+            actions.append('hardlink')
+
+    actions.append('copy')
+
+    tmp = str(dest.parent.joinpath(f'.{dest.name}.{os.getpid()}.'
+                                   f'{id(dest)}.tmp'))
+
+    for action in actions:
+        try:
+            if action == 'hardlink':
+                os.link(str(src), tmp)
+            elif action == 'reflink':
+                reflink(src, tmp)
+            else:
+                copy_data(src, tmp)
+        except OSError:
+            if os.path.lexists(tmp):
+                os.unlink(tmp)
+
+            if action == 'copy':
+                raise
+        else:
+            break
+
+    try:
+        if action != 'hardlink':
+            shutil.copymode(str(src), tmp)
+            os.utime(tmp, ns=(sst.st_atime_ns, sst.st_mtime_ns))
+
+        os.replace(tmp, str(dest))
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+    return action
+
+
+class AssetStage:
+    """
+    Publishes assets in parallel (see publish_file)
+    """
+
+    def __init__(self, mode: str = 'auto', jobs: int = 0):
+        self.mode = mode
+        self.jobs = jobs if jobs else min(32, (os.cpu_count() or 1) + 4)
+        self.pool = None
+        self.pending = []
+
+    def publish(self, src: Path, dest: Path):
+        if not self.pool:
+            self.pool = ThreadPoolExecutor(max_workers=self.jobs)
+
+        self.pending.append(
+            (src, dest, self.pool.submit(publish_file, src, dest, self.mode)))
+
+    def wait(self):
+        """
+        Wait for the pending assets, returns a list of
+        (src, dest, action) tuples. Raises the first error.
+        """
+        results, pending = [], self.pending
+        self.pending = []
+
+        for src, dest, future in pending:
+            results.append((src, dest, future.result()))
+
+        return results
+
+    def shutdown(self):
+        if self.pool:
+            self.pool.shutdown(wait=True)
+            self.pool = None
@@ -0,0 +1,141 @@
+"""
+Pooled HTTP client shared by the resolvers
+"""
+
+import threading
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# Defaults (see configure())
+connect_timeout = 10
+read_timeout = 30
+max_size = 64 * 1024 * 1024
+pool_size = 16
+host_limit = 4
+
+_client = None
+_client_lock = threading.Lock()
+
+
+class ResponseTooLarge(Exception):
+    pass
+
+
+class HttpClient:
+    """
+    HTTP client with keep-alive connection pools, a per-host limit on
+    concurrent requests, timeouts and a maximum response size
+    """
+
+    def __init__(self,
+                 connect_timeout: float = connect_timeout,
+                 read_timeout: float = read_timeout,
+                 max_size: int = max_size,
+                 pool_size: int = pool_size,
+                 host_limit: int = host_limit):
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_size = max_size
+        self.host_limit = host_limit
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+        retry = dict(total=2, backoff_factor=0.5,
+                     status_forcelist=[502, 503, 504])
+
+        try:
+            retries = Retry(allowed_methods=['GET'], **retry)
+        except TypeError:
+            # urllib3 < 1.26
+            retries = Retry(method_whitelist=['GET'], **retry)
+
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size,
+                              max_retries=retries)
+
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def host_semaphore(self, url: str):
+        host = urlparse(url).netloc
+
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = threading.BoundedSemaphore(self.host_limit)
+
+            return self.hosts[host]
+
+    def iter_content(self, url: str, chunk_size: int = 65536):
+        """
+        Stream the body of the resource at url. Raises ResponseTooLarge
+        if the body is larger than max_size.
+        """
+        with self.host_semaphore(url):
+            with self.session.get(url, stream=True,
+                                  timeout=self.timeout) as resp:
+                resp.raise_for_status()
+
+                length = resp.headers.get('Content-Length')
+                if length and length.isdigit() and \
+                        int(length) > self.max_size:
+                    raise ResponseTooLarge(
+                        f'{url}: response too large ({length} bytes)')
+
+                total = 0
+                for chunk in resp.iter_content(chunk_size):
+                    total += len(chunk)
+
+                    if total > self.max_size:
+                        raise ResponseTooLarge(
+                            f'{url}: response larger than {self.max_size} '
+                            'bytes')
+
+                    yield chunk
+
+    def get(self, url: str):
+        """
+        Returns the body of the resource at url (bytes)
+        """
+        return b''.join(self.iter_content(url))
+
+    def close(self):
+        self.session.close()
+
+
+def configure(timeout: float = None, max_size_mib: int = None):
+    """
+    Set the read timeout and the maximum response size of the shared
+    client
+    """
+    global _client, read_timeout, max_size
+
+    if timeout:
+        read_timeout = timeout
+    if max_size_mib:
+        max_size = max_size_mib * 1024 * 1024
+
+    with _client_lock:
+        if _client:
+            _client.close()
+            _client = None
+
+
+def get_client():
+    """
+    Returns the shared HTTP client
+    """
+    global _client
+
+    with _client_lock:
+        if not _client:
+            _client = HttpClient(connect_timeout=connect_timeout,
+                                 read_timeout=read_timeout,
+                                 max_size=max_size,
+                                 pool_size=pool_size,
+                                 host_limit=host_limit)
+
+        return _client
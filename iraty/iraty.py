@@ -1,16 +1,17 @@
 import sys
 import os
+import hashlib
+import json
 import os.path
 import io
 import inspect
 import re
 import traceback
 import shutil
-import functools
-import http.server
-import socketserver
 import pkg_resources
 import subprocess
+from datetime import datetime
+from datetime import timezone
 from pathlib import Path
 from typing import Union, IO
 from urllib.parse import urlparse
@@ -20,16 +21,44 @@ from domonic.html import *  # noqa
 from omegaconf import OmegaConf
 from omegaconf import DictConfig
 from omegaconf.basecontainer import BaseContainer
-from jinja2 import Environment, FileSystemLoader, select_autoescape
-
-import markdown
-from markdown.extensions.toc import TocExtension
 
 from .config import node_get_config
 from .config import node_configure
 from .config import node_configure_default
 
 from .omega import shove
+from .omega import load_document
+from .cache import JsonCache
+from .cache import file_stamp
+from .fsutil import AssetStage
+from .fsutil import atomic_copy
+from .fsutil import publish_file
+from .fsutil import atomic_write
+from .fsutil import file_digest
+from .fsutil import staging_directory
+from .fsutil import swap_directory
+from .lint import lint
+from .check import check
+from .metrics import Metrics
+from .context import BuildContext
+from .context import current
+from .batch import batch
+from .server import render_serve
+from .serve import http_serve
+from .serve import lazy_serve
+from .serve import car_serve
+from .unixfs import DagBuilder
+from .unixfs import UnsupportedDag
+from .unixfs import cid_str
+from .car import export_car
+from .buildcache import BuildCache
+from .buildcache import digest
+from .buildcache import open_store
+from .shard import ShardError
+from .shard import merge
+from .shard import parse_shard
+from .shard import shard_of
+from .shard import write_manifest
 
 try:
     from html5print import HTMLBeautifier
@@ -44,6 +73,7 @@ from ipfshttpclient import client
 from ipfshttpclient.exceptions import ErrorResponse
 
 from . import resolvers
+from . import httpclient
 from . import appdirs
 from . import i18n
 
@@ -63,36 +93,13 @@ def assert_v(version: str, minimum: str = '0.4.23',
 
 
 client.assert_version = assert_v
-md = markdown.Markdown(extensions=[TocExtension(permalink=True)])
 
 
 def relative(path: Path, dirp: Path):
     return os.path.relpath(str(path), start=str(dirp))
 
 
-def http_serve(directory: Path, port=8000):
-    """
-    Serve via HTTP the specified directory on the given TCP port
-    """
-
-    Handler = functools.partial(
-        http.server.SimpleHTTPRequestHandler,
-        directory=str(directory)
-    )
-
-    with socketserver.TCPServer(("", port), Handler) as httpd:
-        print(f'Serving via HTTP at: http://localhost:{port}', file=sys.stdout)
-
-        try:
-            httpd.serve_forever()
-        except KeyboardInterrupt:
-            httpd.shutdown()
-            httpd.server_close()
-        except OSError as err:
-            print(str(err), file=sys.stderr)
-
-
-def handle_textnode(dom, pn, text: str, lang=None):
+def handle_textnode(ctx, dom, pn, text: str, lang=None):
     def toke(tokens):
         # Recursively process tokens from the markdown toc extension
         for token in tokens:
@@ -106,17 +113,28 @@ def handle_textnode(dom, pn, text: str, lang=None):
                 toke(token['children'])
 
     if pn.tagName in ['p', 'span']:
-        html = md.convert(text)
+        html, toc_tokens = ctx.md_convert(text)
 
         # Process toc tokens
-        toke(md.toc_tokens)
+        toke(toc_tokens)
 
         pn.innerText(html)
     else:
         pn.innerText(text)
 
 
-jenv = Environment(autoescape=select_autoescape())
+# Asset types renamed with --fingerprint (other files, like robots.txt or
+# favicon.ico, keep their URL)
+fingerprint_exts = [
+    '.css', '.js', '.mjs', '.map', '.wasm',
+    '.png', '.jpg', '.jpeg', '.gif', '.webp', '.avif', '.svg',
+    '.woff', '.woff2', '.ttf', '.otf', '.eot',
+    '.mp3', '.ogg', '.mp4', '.webm'
+]
+
+# References to other files in stylesheets (url() and @import)
+css_url_re = re.compile(r'(url\(\s*[\'"]?)([^\'"\)\s]+)')
+css_import_re = re.compile(r'(@import\s+[\'"])([^\'"]+)')
 
 assets_root = Path(pkg_resources.resource_filename(
     'iraty.assets',
@@ -124,6 +142,56 @@ assets_root = Path(pkg_resources.resource_filename(
 ))
 
 
+def template_paths(input_path: Path):
+    """
+    Jinja templates search paths for an input file or directory
+    """
+    if input_path.is_file():
+        return [input_path.parent]
+
+    return [
+        input_path,
+        input_path.joinpath('templates'),
+        assets_root.joinpath('jinja2')
+    ]
+
+
+def build_context(input_path: Path, ipfs_client, metrics=None):
+    return BuildContext(
+        ipfs_client=ipfs_client,
+        root_path=input_path if input_path.is_dir() else input_path.parent,
+        search_paths=template_paths(input_path),
+        metrics=metrics
+    )
+
+
+def source_date(path: Path):
+    """
+    Fixed build time for reproducible builds (UTC): SOURCE_DATE_EPOCH,
+    or the time of the last git commit of path
+    """
+    epoch = os.getenv('SOURCE_DATE_EPOCH')
+
+    if not epoch:
+        try:
+            epoch = subprocess.check_output(
+                ['git', 'log', '-1', '--format=%ct'],
+                cwd=str(path if path.is_dir() else path.parent),
+                stderr=subprocess.DEVNULL
+            ).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            epoch = None
+
+    try:
+        return datetime.fromtimestamp(int(epoch), timezone.utc).replace(
+            tzinfo=None)
+    except (TypeError, ValueError):
+        print('SOURCE_DATE_EPOCH is not set (and the sources are not in a '
+              'git repository), using the epoch as build time',
+              file=sys.stderr)
+        return datetime(1970, 1, 1)
+
+
 def section_id(content: str):
     san = ''.join(re.split('[^a-zA-Z0-9\\s]*', content.lower()))
     san = re.sub('\\s+', '-', san)
@@ -181,9 +249,12 @@ def convert(ira, node, dom, destdir: Path, parent=None, lang=None):
                         comps = rel_destdir.split('/')
 
                         hrefl = relative(value, comps[0] if comps else '')
-                        pn.setAttribute(attr.replace('_auto', ''), hrefl)
+                        pn.setAttribute(attr.replace('_auto', ''),
+                                        ira.asset_url(hrefl, rel_destdir))
                     else:
                         pn.setAttribute(attr, value)
+                elif attr in ['href', 'src'] and is_str(value):
+                    pn.setAttribute(attr, ira.asset_url(value, rel_destdir))
                 else:
                     pn.setAttribute(attr, value)
             elif tagn in dots or pn.tagName in dots:
@@ -192,21 +263,26 @@ def convert(ira, node, dom, destdir: Path, parent=None, lang=None):
                 continue
             elif tagn == '_' and is_str(value):
                 # Tag text contents
-                handle_textnode(dom, pn, value, lang=lang)
+                handle_textnode(ira.ctx, dom, pn, value, lang=lang)
             elif tagn == 'jinja':
                 args = {}
 
                 if is_str(value):
-                    tmpl = jenv.from_string(value)
+                    tmpl = ira.ctx.jenv.from_string(value)
                 elif isinstance(value, dict):
                     args = value.get('with', {})
                     tpath = value.get('from')
                     template = value.get('template')
 
                     if is_str(tpath):
-                        tmpl = jenv.get_template(tpath)
+                        tmpl = ira.ctx.jenv.get_template(tpath)
+
+                        calls = current().calls
+                        if calls is not None and tmpl.filename:
+                            # Dependency of the page (build cache)
+                            calls.append(('template', (tmpl.filename,)))
                     elif is_str(template):
-                        tmpl = jenv.from_string(template)
+                        tmpl = ira.ctx.jenv.from_string(template)
 
                 if tmpl:
                     args.update({'langs': ira.site_langs})
@@ -222,7 +298,7 @@ def convert(ira, node, dom, destdir: Path, parent=None, lang=None):
     elif isinstance(node, list):
         [convert(ira, subn, dom, destdir, parent=pn, lang=lang) for subn in node]
     elif isinstance(node, str):
-        handle_textnode(dom, pn, node, lang=lang)
+        handle_textnode(ira.ctx, dom, pn, node, lang=lang)
 
 
 class IratySiteConfig:
@@ -289,6 +365,10 @@ def dom_find(dom, tag: str):
     return found
 
 
+class PageError(Exception):
+    pass
+
+
 class TOC:
     def __init__(self):
         self.links = []
@@ -316,21 +396,53 @@ class Iraty:
         self.sitecfg.init()
 
         self.outdirp = Path(self.sitecfg.c.output_path)
+        self.output_path = self.outdirp
+        self.staging = False
+        self.outputs = set()
+        self.assets = AssetStage(mode=args.asset_mode, jobs=args.jobs)
+        self.fingerprints = {}
+
+        # Contents of the fingerprinted stylesheets whose references
+        # were rewritten
+        self.rewritten = {}
         self.lang_default = i18n.lang_get(self.sitecfg.c.language_default)
         self.site_langs = []
+        self.metrics = Metrics()
+        self.ctx = build_context(input_path, ipfs_client,
+                                 metrics=self.metrics)
+        self._layouts = {}
+        self._head_fragments = {}
+
+        self.build_cache = None
+
+        if args.reproducible:
+            self.ctx.build_time = source_date(input_path)
+
+        # Shard of the build (index, count), or None
+        self.shard = parse_shard(args.shard) if args.shard else None
+
+    @property
+    def primary(self):
+        """
+        True if this build writes the files shared by all the pages
+        (assets, redirects): always, unless it's a shard other than the
+        first
+        """
+        return not self.shard or self.shard[0] == 1
 
     def start(self):
         if os.getenv('HOME') == str(self.outdirp):
             raise Exception('Not using HOME as output, dude')
 
-        self.outdirp.mkdir(parents=True, exist_ok=True)
+        if self.args.staged and self.input_path.is_dir():
+            # Build into a staging directory, swapped with the output
+            # directory once the build is complete
+            self.output_path = Path(os.path.abspath(str(self.outdirp)))
+            self.output_path.parent.mkdir(parents=True, exist_ok=True)
+            self.outdirp = staging_directory(self.output_path)
+            self.staging = True
 
-        if self.sitecfg.exists() and self.args.purge:
-            for root, dirs, files in os.walk(self.outdirp):
-                for file in files:
-                    # Only purge html/css files
-                    if file.endswith('.html') or file.endswith('.css'):
-                        os.unlink(os.path.join(root, file))
+        self.outdirp.mkdir(parents=True, exist_ok=True)
 
         for iso639 in self.args.langs.split(','):
             lang = i18n.lang_get(iso639)
@@ -338,33 +450,462 @@ class Iraty:
             if lang and lang not in self.site_langs:
                 self.site_langs.append(lang)
 
+    def output_written(self, dest: Path):
+        self.outputs.add(os.path.normpath(str(dest)))
+
+    def asset_published(self, dest: Path, action: str):
+        self.output_written(dest)
+        self.metrics.inc('assets_total', action=action)
+
+        if action != 'unchanged':
+            self.metrics.inc('output_bytes_total', dest.stat().st_size,
+                             kind='asset')
+
+    def theme_css(self):
+        """
+        Returns the path of the theme's main CSS (or None)
+        """
+        theme_name = os.path.basename(self.sitecfg.c.theme)
+        themedp = Path(pkg_resources.resource_filename(
+            'iraty.themes',
+            self.sitecfg.c.theme
+        ))
+
+        if theme_name != 'null' and themedp.is_dir():
+            return themedp.joinpath(f'{theme_name}.css')
+
+    def fingerprint_assets(self, path: Path):
+        """
+        Compute the content-hashed names (name.<hash>.ext) of the assets
+        of the website (digests are cached between builds)
+        """
+        cache = JsonCache('fingerprints').load()
+        sources = {}
+
+        themecss = self.theme_css()
+        if themecss:
+            sources[themecss.name] = themecss
+
+        sources['lang-selector.css'] = assets_root.joinpath('lang-selector.css')
+
+        for root, dirs, files in os.walk(path):
+            rr = root.replace(str(path), '').lstrip(os.sep)
+
+            for file in files:
+                if file.startswith('.') or \
+                        os.path.splitext(file)[1].lower() not in fingerprint_exts:
+                    continue
+
+                sources[os.path.normpath(os.path.join(rr, file))] = \
+                    Path(root).joinpath(file)
+
+        stylesheets = {}
+
+        for relp, src in sources.items():
+            if relp.endswith('.css'):
+                # Fingerprinted after the files they reference
+                stylesheets[relp] = src
+                continue
+
+            key = str(src.resolve())
+            stamp = list(file_stamp(src))
+            entry = cache.get(key)
+
+            if entry and entry[:2] == stamp:
+                digest = entry[2]
+            else:
+                digest = file_digest(src)
+                cache.set(key, stamp + [digest])
+
+            stem, ext = os.path.splitext(relp)
+            self.fingerprints[relp] = f'{stem}.{digest[:8]}{ext}'
+
+        for relp in stylesheets:
+            self.fingerprint_css(relp, stylesheets, set())
+
+        cache.save()
+
+    def fingerprint_css(self, relp: str, stylesheets: dict, visiting: set):
+        """
+        Rewrite the references (url() and @import) of the stylesheet relp
+        to the fingerprinted names, and fingerprint the result (the
+        stylesheets it references are fingerprinted first)
+        """
+        if relp in self.fingerprints:
+            return
+
+        visiting.add(relp)
+        rel_dir = os.path.dirname(relp)
+        data = stylesheets[relp].read_bytes()
+
+        def rewrite(match):
+            url = match.group(2)
+            target = os.path.normpath(
+                os.path.join(rel_dir, urlparse(url).path))
+
+            if target in stylesheets and target not in visiting:
+                self.fingerprint_css(target, stylesheets, visiting)
+
+            return match.group(1) + self.asset_url(url, rel_dir)
+
+        text = data.decode('utf-8', 'surrogateescape')
+        text = css_import_re.sub(rewrite, css_url_re.sub(rewrite, text))
+        out = text.encode('utf-8', 'surrogateescape')
+
+        if out != data:
+            self.rewritten[relp] = out
+
+        stem, ext = os.path.splitext(relp)
+        digest = hashlib.sha256(out).hexdigest()
+        self.fingerprints[relp] = f'{stem}.{digest[:8]}{ext}'
+
+    def publish_asset(self, src: Path, relp: str):
+        """
+        Publish the asset src (relp is relative to the output root)
+        """
+        dest = self.asset_dest(relp)
+        data = self.rewritten.get(os.path.normpath(relp))
+
+        if data is None:
+            self.assets.publish(src, dest)
+            return
+
+        # Stylesheet with rewritten references (its name is a hash of
+        # the rewritten contents)
+        if dest.is_file():
+            self.asset_published(dest, 'unchanged')
+        else:
+            atomic_write(dest, data)
+            self.asset_published(dest, 'copy')
+
+    def asset_dest(self, relp: str):
+        """
+        Output path of an asset (relp is relative to the output root)
+        """
+        relp = os.path.normpath(relp)
+        return self.outdirp.joinpath(self.fingerprints.get(relp, relp))
+
+    def asset_url(self, url: str, rel_destdir: str):
+        """
+        Rewrite a relative URL pointing to an asset to its fingerprinted name
+        """
+        if not self.fingerprints:
+            return url
+
+        parsed = urlparse(url)
+        if parsed.scheme or parsed.netloc or not parsed.path or \
+                parsed.path.startswith('/'):
+            return url
+
+        target = os.path.normpath(os.path.join(rel_destdir, parsed.path))
+        hashed = self.fingerprints.get(target)
+
+        if not hashed:
+            return url
+
+        return parsed._replace(path=relative(hashed, rel_destdir)).geturl()
+
+    def write_asset_manifest(self):
+        """
+        Write the asset manifest (asset-manifest.json), mapping the
+        original asset names to the fingerprinted names, and remove the
+        assets of the previous build that are not referenced anymore
+        """
+        manifestp = self.outdirp.joinpath('asset-manifest.json')
+
+        try:
+            with open(manifestp, 'rt') as fd:
+                previous = json.load(fd)
+            assert isinstance(previous, dict)
+        except Exception:
+            previous = {}
+
+        current = set(self.fingerprints.values())
+
+        for old in previous.values():
+            if not is_str(old) or old in current or os.path.isabs(old) or \
+                    os.path.normpath(old).startswith('..'):
+                continue
+
+            oldp = self.outdirp.joinpath(old)
+            if oldp.is_file() and os.path.normpath(str(oldp)) not in \
+                    self.outputs:
+                oldp.unlink()
+
+        atomic_write(manifestp, json.dumps(
+            self.fingerprints, indent=2, sort_keys=True).encode())
+        self.output_written(manifestp)
+
+    def wait_assets(self):
+        for src, dest, action in self.assets.wait():
+            self.asset_published(dest, action)
+
+    def purge_stale(self):
+        """
+        Remove the html/css files from previous builds that were not
+        written by this build (done once the build is complete)
+        """
+        if not self.sitecfg.exists() or not self.args.purge or self.staging:
+            return
+
+        for root, dirs, files in os.walk(self.outdirp):
+            for file in files:
+                # Only purge html/css files
+                if not file.endswith('.html') and not file.endswith('.css'):
+                    continue
+
+                fp = os.path.normpath(os.path.join(root, file))
+                if fp not in self.outputs:
+                    os.unlink(fp)
+
+    def keep_previous(self, dest: Path):
+        """
+        Keep the previous output of a page that failed to render
+        """
+        self.output_written(dest)
+
+        if self.staging:
+            prev = self.output_path.joinpath(dest.relative_to(self.outdirp))
+
+            if prev.is_file():
+                dest.parent.mkdir(parents=True, exist_ok=True)
+                atomic_copy(prev, dest)
+
+    def finish_staging(self, success: bool):
+        if not self.staging:
+            return
+
+        if success:
+            swap_directory(self.outdirp, self.output_path)
+            self.outdirp = Path(os.path.realpath(str(self.output_path)))
+        else:
+            shutil.rmtree(str(self.outdirp), ignore_errors=True)
+            self.outdirp = self.output_path
+
+        self.staging = False
+
     def ipfs_add(self, src):
+        with self.metrics.timed('add'):
+            try:
+                ret = self.iclient.add(src, cid_version=1,
+                                       recursive=True)
+                if isinstance(ret, list):
+                    entry = ret[-1]
+                else:
+                    entry = ret
+
+                self.metrics.inc('ipfs_uploaded_bytes_total',
+                                 int(entry.get('Size', 0)))
+                return entry['Hash']
+            except Exception as err:
+                self.metrics.error('add')
+                print(f'IPFS Error: {err}', file=sys.stderr)
+
+    def local_cid(self, path: Path):
+        """
+        Compute the CID of path locally (without the IPFS daemon)
+        """
+        cache = JsonCache('cids').load()
+
+        with self.metrics.timed('cid'):
+            try:
+                link = DagBuilder(cache=cache).add_path(path)
+            except UnsupportedDag as err:
+                print(f'Cannot compute the CID locally: {err}',
+                      file=sys.stderr)
+                return None
+            finally:
+                cache.save()
+
+        return cid_str(link.cid)
+
+    def car_export(self):
+        """
+        Export the output directory as a CAR file
+        """
+        dest = Path(self.args.car_path if self.args.car_path else
+                    f'{os.path.normpath(str(self.output_path))}.car')
+
+        with self.metrics.timed('car'):
+            try:
+                cid = export_car(self.outdirp, dest)
+            except Exception as err:
+                self.metrics.error('car')
+                print(f'Error exporting CAR file: {err}', file=sys.stderr)
+                return None
+
+        print(f'{dest}: {cid}', file=sys.stderr)
+        return cid
+
+    def ipfs_pinned(self, cid: str):
         try:
-            ret = self.iclient.add(src, cid_version=1,
-                                   recursive=True)
-            if isinstance(ret, list):
-                entry = ret[-1]
-            else:
-                entry = ret
+            resp = self.iclient.pin.ls(cid, type='recursive')
+            return cid in resp.get('Keys', {})
+        except Exception:
+            return False
 
-            return entry['Hash']
-        except Exception as err:
-            print(f'IPFS Error: {err}', file=sys.stderr)
+    def ipfs_add_site(self, local_cid: str = None):
+        """
+        Add the output directory to IPFS, unless the node already has
+        (pinned) the DAG for the locally computed CID
+        """
+        cid = local_cid if local_cid else self.local_cid(self.outdirp)
+
+        if cid and not self.args.force_add and self.ipfs_pinned(cid):
+            self.metrics.inc('ipfs_add_skipped_total')
+            return cid
+
+        added = self.ipfs_add(str(self.outdirp))
+
+        if added and cid and added != cid:
+            print(f'Warning: local CID ({cid}) differs from the CID '
+                  f'returned by the node ({added})', file=sys.stderr)
+
+        return added
+
+    def deploy_key(self):
+        return json.dumps([
+            os.path.abspath(str(self.input_path)),
+            self.args.ipfs_node,
+            self.args.ipns_key_name,
+            self.args.ipns_key_id,
+            self.get_target_rps() if self.args.pintoremote else None
+        ])
+
+    def last_deploy(self):
+        """
+        Returns the CID of the last deploy of the website (to the same
+        node, IPNS key and remote pinning service)
+        """
+        return JsonCache('deploys').load().get(self.deploy_key())
+
+    def record_deploy(self, cid: str):
+        cache = JsonCache('deploys').load()
+        cache.set(self.deploy_key(), cid)
+        cache.save()
 
     def ipfs_pinremote(self, service, cid):
+        with self.metrics.timed('pin'):
+            try:
+                resp = self.iclient.pinremote.add(service, cid)
+                assert resp['Status'] == 'pinned'
+            except ErrorResponse as err:
+                self.metrics.error('pin')
+                print(f'Pin to remote error: {err}', file=sys.stderr)
+                return False
+            except Exception as err:
+                self.metrics.error('pin')
+                print(f'Unknown Error: {err}', file=sys.stderr)
+                return False
+            else:
+                return True
+
+    def dump_metrics(self):
+        """
+        Write the build metrics if a metrics file was requested
+        """
+        if not self.args.metrics_path:
+            return
+
+        info = self.ctx.md_convert.cache_info()
+        self.metrics.cache('markdown', True, info.hits)
+        self.metrics.cache('markdown', False, info.misses)
+
         try:
-            resp = self.iclient.pinremote.add(service, cid)
-            assert resp['Status'] == 'pinned'
-        except ErrorResponse as err:
-            print(f'Pin to remote error: {err}', file=sys.stderr)
-            return False
+            self.metrics.dump(Path(self.args.metrics_path),
+                              fmt=self.args.metrics_format)
         except Exception as err:
-            print(f'Unknown Error: {err}', file=sys.stderr)
-            return False
+            print(f'Error writing metrics: {err}', file=sys.stderr)
+
+    def head_fragment(self, destdir: Path = None):
+        """
+        Returns the elements added to the pages written to destdir (theme
+        CSS, charset meta, lang-selector CSS in head, the language
+        selector in body). Computed once per output directory.
+        """
+        key = os.path.normpath(str(destdir)) if destdir else None
+
+        if key in self._head_fragments:
+            return self._head_fragments[key]
+
+        themecss = self.theme_css()
+        if not themecss:
+            return None
+
+        dest = self.asset_dest(themecss.name)
+
+        if os.path.normpath(str(dest)) not in self.outputs:
+            # Publish the theme's main CSS (once per build)
+            self.asset_published(
+                dest, publish_file(themecss, dest,
+                                   mode=self.args.asset_mode))
+
+        # Compute the CSS's relative path to the root output dir
+        if destdir:
+            css_relp = os.path.relpath(str(dest), start=str(destdir))
         else:
-            return True
+            css_relp = dest.name
+
+        fragment = {
+            'head': [{
+                'link': {
+                    '_rel': 'stylesheet',
+                    '_type': 'text/css',
+                    '_href': css_relp
+                }
+            }, {
+                'meta': {
+                    '_content': 'text/html; charset=utf-8',
+                    '_http-equiv': 'Content-Type',
+                }
+            }],
+            'body': None
+        }
+
+        if len(self.site_langs) > 1:
+            sel_outp = self.asset_dest('lang-selector.css')
+            fragment['head'].append({
+                'link': {
+                    '_rel': 'stylesheet',
+                    '_type': 'text/css',
+                    '_href': os.path.relpath(str(sel_outp),
+                                             start=str(destdir))
+                }
+            })
+            fragment['body'] = {
+                '.': OmegaConf.to_container(resolvers.lang_selector())
+            }
+
+        self._head_fragments[key] = fragment
+        return fragment
+
+    def write_redirect(self, dest: Path, url: str):
+        """
+        Write a page redirecting to url (with the site's head elements)
+        """
+        dom = html()
+        dom._toc = TOC()
+        fragment = self.head_fragment(dest.parent)
+
+        convert(self, {
+            'head': {
+                'meta': [{
+                    '_http-equiv': 'Refresh',
+                    '_content': f'0; url={url}'
+                }],
+                '...': fragment['head'] if fragment else []
+            }
+        }, dom, dest.parent)
+
+        return self.output_dom(dom, dest=dest)
 
     def output_dom(self, dom, dest: Path = None, fd=None):
+        if self.args.reproducible:
+            # Stable attribute order
+            for node in dom.iter():
+                if getattr(node, 'kwargs', None):
+                    node.kwargs = dict(sorted(node.kwargs.items()))
+
         tocdefs = dom_find(dom, 'toc')
 
         for tocn in tocdefs:
@@ -404,10 +945,7 @@ class Iraty:
 
             tocn.parentNode.replaceChild(top, tocn)
 
-        if dest:
-            output = open(str(dest), 'wb')
-        else:
-            output = fd if fd else io.BytesIO()
+        output = fd if fd and not dest else io.BytesIO()
         try:
             if have_beautifier and 0:
                 out = HTMLBeautifier.beautify(render(dom),
@@ -420,7 +958,15 @@ class Iraty:
                 if output is sys.stdout:
                     output.write(f'{dom}')
                 else:
-                    output.write(f'{dom}'.encode())
+                    out = f'{dom}'.encode()
+                    output.write(out)
+
+                    if dest:
+                        atomic_write(dest, out)
+                        self.output_written(dest)
+
+                        self.metrics.inc('output_bytes_total', len(out),
+                                         kind='html')
 
             if output is not sys.stdout:
                 output.seek(0, 0)
@@ -434,18 +980,14 @@ class Iraty:
                      destdir_root: Path = None,
                      i18n_out=True,
                      basename=None,
-                     output=False):
+                     output=False,
+                     ctx=None,
+                     raise_errors=False):
         lang = None
         dom = html()
         dom._toc = TOC()
 
         try:
-            theme_name = os.path.basename(self.sitecfg.c.theme)
-            themedp = Path(pkg_resources.resource_filename(
-                'iraty.themes',
-                self.sitecfg.c.theme
-            ))
-
             destdir = destdir_root
 
             if destdir:
@@ -455,82 +997,44 @@ class Iraty:
                 basename, lang = i18n.language_target(source)
 
                 with open(source, 'rt') as fd:
-                    foc = OmegaConf.load(fd)
+                    foc = load_document(fd)
             elif isinstance(source, io.StringIO):
-                with open(source, 'rt') as fd:
-                    foc = OmegaConf.load(fd)
+                foc = load_document(source)
             elif isinstance(source, DictConfig):
                 foc = source
             else:
                 raise Exception(f'Invalid source input: {source}')
 
-            if theme_name != 'null' and themedp.is_dir():
-                dest = self.outdirp.joinpath(f'{theme_name}.css')
-
-                if not dest.is_file():
-                    # Copy the theme's main CSS
-                    shutil.copy(
-                        str(themedp.joinpath(f'{theme_name}.css')),
-                        str(self.outdirp)
-                    )
-
-                # Compute the CSS's relative path to the root output dir
-                if destdir_root:
-                    css_relp = os.path.relpath(
-                        str(dest), start=str(destdir))
-                else:
-                    css_relp = f'{theme_name}.css'
-
-                # Reference the CSS in <head>
-                css_link = {
-                    'link': {
-                        '_rel': 'stylesheet',
-                        '_type': 'text/css',
-                        '_href': css_relp
-                    }
-                }
-
-                utf8_meta = {
-                    'meta': {
-                        '_content': 'text/html; charset=utf-8',
-                        '_http-equiv': 'Content-Type',
-                    }
-                }
+            fragment = self.head_fragment(destdir if destdir_root else None)
 
+            if fragment:
                 head = foc.get('head')
                 if not head:
                     foc['head'] = {}
                     head = foc['head']
 
-                shove(head, css_link)
-                shove(head, utf8_meta)
+                for elem in fragment['head']:
+                    shove(head, elem)
 
-                sel_outp = self.outdirp.joinpath('lang-selector.css')
-                sel_relpath = os.path.relpath(str(sel_outp), start=str(destdir))
+                if fragment['body']:
+                    shove(foc.get('body'), fragment['body'], pos='first')
 
-                sel_css_link = {
-                    'link': {
-                        '_rel': 'stylesheet',
-                        '_type': 'text/css',
-                        '_href': sel_relpath
-                    }
-                }
+            with (ctx if ctx else self.ctx).activate():
+                doc = resolvers.resolve(foc)
 
-                if len(self.site_langs) > 1:
-                    shove(foc.get('head'), sel_css_link)
+                convert(
+                    self,
+                    doc,
+                    dom,
+                    destdir,
+                    lang=lang
+                )
+        except Exception:
+            self.metrics.error('render')
 
-                    shove(foc.get('body'), {
-                        '.': '${lang_selector:}'
-                    }, pos='first')
+            if raise_errors:
+                raise
 
-            convert(
-                self,
-                OmegaConf.to_container(foc, resolve=True),
-                dom,
-                destdir,
-                lang=lang
-            )
-        except Exception:
             traceback.print_exc()
             return None, None, None
 
@@ -570,6 +1074,12 @@ class Iraty:
         Find the closest .layout.yaml file (hierarchy-wise) to
         the file referenced by fp.
         """
+        if fp.parent in self._layouts:
+            self.metrics.cache('layout', True)
+            return self._layouts[fp.parent]
+
+        self.metrics.cache('layout', False)
+
         current = fp.parent
         dirs = [current]
 
@@ -582,24 +1092,178 @@ class Iraty:
 
             if layoutp.is_file():
                 # TODO: check that this is a valid yaml
+                self._layouts[fp.parent] = layoutp
                 return layoutp
 
+        self._layouts[fp.parent] = None
+
+    def page_destdir(self, fp: Path, rr: str):
+        """
+        Output directory for the page fp (in the directory rr relative to
+        the root), per-language pages go in the language's directory
+        """
+        basename, lang = i18n.language_target(fp)
+
+        if lang:
+            return self.outdirp.joinpath(lang.pt1).joinpath(rr)
+        else:
+            return self.outdirp.joinpath(rr)
+
+    def render_page(self, fp: Path, root: Path, rr: str, ddest_def: Path,
+                    ctx=None):
+        """
+        Render the page fp (inside its closest layout, if there's one),
+        with the build context ctx (the build's context by default).
+        Returns the DOM and the destination path of the page.
+
+        Raises PageError if the page or its layout can't be rendered.
+        """
+        layoutp = self.find_closest_layout(fp, root)
+
+        dom_layout, blocks = None, []
+        if layoutp:
+            # Parse the layout
+            try:
+                dom_layout, lang, _ = self.process_file(
+                    layoutp, destdir_root=ddest_def, ctx=ctx,
+                    raise_errors=True)
+            except Exception as err:
+                raise PageError(
+                    f'{fp}: cannot render layout {layoutp}: '
+                    f'{type(err).__name__}: {err}') from err
+
+            # Parse declared blocks
+            for node in dom_layout.iter():
+                if node.name.startswith('block_'):
+                    blocks.append(node)
+
+        def findblock(name):
+            for blk in blocks:
+                if blk.name == name:
+                    return blk
+
+        ddest = self.page_destdir(fp, rr)
+        ddest.mkdir(parents=True, exist_ok=True)
+
+        try:
+            dom, _lang, dest = self.process_file(fp, destdir_root=ddest,
+                                                 ctx=ctx, raise_errors=True)
+        except Exception as err:
+            raise PageError(
+                f'{fp}: {type(err).__name__}: {err}') from err
+
+        if dom_layout and len(blocks) > 0:
+            for node in dom.iter():
+                if node.name.startswith('block_'):
+                    blk = findblock(node.name)
+
+                    if blk is None or blk.parentNode is None:
+                        continue
+
+                    # Replace the node
+                    blk.parentNode.replaceChild(
+                        node.firstChild, blk)
+
+        return dom_layout if dom_layout else dom, dest
+
+    def build_salt(self, path: Path):
+        """
+        Digest of what the pages depend on, other than their source and
+        layout: theme, languages, asset fingerprints, reproducible mode,
+        Jinja templates
+        """
+        themecss = self.theme_css()
+        templates = []
+
+        for tpath in self.ctx.search_paths:
+            for root, dirs, files in os.walk(str(tpath)):
+                dirs.sort()
+
+                for file in sorted(files):
+                    if file.endswith('.jinja2'):
+                        fp = Path(root).joinpath(file)
+                        templates += [str(fp), file_digest(fp)]
+
+        return digest(
+            self.sitecfg.c.theme,
+            file_digest(themecss) if themecss else '',
+            ','.join(lang.pt1 for lang in self.site_langs),
+            self.lang_default.pt1 if self.lang_default else '',
+            json.dumps(self.fingerprints, sort_keys=True),
+            self.args.reproducible,
+            *templates
+        )
+
+    def render_cached(self, fp: Path, root: Path, rr: str, ddest_def: Path):
+        """
+        Render the page fp and write it, or write it from the build cache
+        """
+        cache = self.build_cache
+        layoutp = self.find_closest_layout(fp, root)
+        key = cache.page_key(relative(fp, root), fp, layoutp)
+        html = cache.lookup(key)
+
+        if html is not None:
+            basename, lang = i18n.language_target(fp)
+            ddest = self.page_destdir(fp, rr)
+            ddest.mkdir(parents=True, exist_ok=True)
+
+            # Publishes the theme's CSS
+            self.head_fragment(ddest)
+
+            dest = ddest.joinpath(f'{basename}.html')
+            atomic_write(dest, html)
+            self.output_written(dest)
+            self.metrics.inc('output_bytes_total', len(html), kind='html')
+            return
+
+        self.ctx.calls = []
+
+        try:
+            dom, dest = self.render_page(fp, root, rr, ddest_def)
+            out = self.output_dom(dom, dest=dest)
+        finally:
+            calls, self.ctx.calls = self.ctx.calls, None
+
+        if out is None:
+            raise PageError(f'{fp}: cannot write {dest}')
+
+        deps = cache.dependencies(calls, resolvers.kinds)
+        if deps is not None:
+            cache.store_page(key, deps, out.getvalue())
+
     def process_directory(self, path: Path):
         # Copy necessary assets
         css_langsel = assets_root.joinpath('lang-selector.css')
 
-        if css_langsel.is_file():
-            shutil.copy(css_langsel, self.outdirp)
+        if self.args.fingerprint:
+            self.fingerprint_assets(path)
+
+        if self.args.build_cache:
+            self.build_cache = BuildCache(open_store(self.args.build_cache),
+                                          self.build_salt(path), path,
+                                          metrics=self.metrics)
+            self.ctx.build_cache = self.build_cache
+
+        if css_langsel.is_file() and self.primary:
+            dest = self.asset_dest(css_langsel.name)
+            self.output_written(dest)
+            self.assets.publish(css_langsel, dest)
 
         target_langs = []
 
+        failures = []
+
         try:
             for root, dirs, files in os.walk(path):
                 rr = root.replace(str(path), '').lstrip(os.sep)
 
+                if self.args.reproducible:
+                    dirs.sort()
+                    files.sort()
+
                 for file in files:
                     fp = Path(root).joinpath(file)
-                    layoutp = self.find_closest_layout(fp, path)
 
                     ddest_def = self.outdirp.joinpath(rr)
                     ddest_def.mkdir(parents=True, exist_ok=True)
@@ -608,89 +1272,115 @@ class Iraty:
                         # Ignore dot files (reserved)
                         continue
 
-                    dom_layout, blocks = None, []
-                    if layoutp:
-                        # Parse the layout
-                        dom_layout, lang, _ = self.process_file(layoutp,
-                                                                destdir_root=ddest_def)
-
-                        if dom_layout:
-                            # Parse declared blocks
-
-                            for node in dom_layout.iter():
-                                if node.name.startswith('block_'):
-                                    blocks.append(node)
-
-                    def findblock(name):
-                        for blk in blocks:
-                            if blk.name == name:
-                                return blk
-
                     if fp.name.endswith('.yaml') or fp.name.endswith('.yml'):
                         basename, lang = i18n.language_target(fp)
                         if lang and lang not in target_langs:
                             target_langs.append(lang)
 
-                        if lang:
-                            ddest = self.outdirp.joinpath(lang.pt1).joinpath(rr)
-                            ddest.mkdir(parents=True, exist_ok=True)
+                        if self.shard and shard_of(
+                                os.path.join(rr, file),
+                                self.shard[1]) != self.shard[0]:
+                            # Rendered by another shard
+                            continue
+
+                        try:
+                            with self.metrics.timed('render'):
+                                if self.build_cache:
+                                    self.render_cached(fp, path, rr,
+                                                       ddest_def)
+                                else:
+                                    dom, dest = self.render_page(
+                                        fp, path, rr, ddest_def)
+
+                                    if self.output_dom(dom, dest=dest) is None:
+                                        raise PageError(
+                                            f'{fp}: cannot write {dest}')
+                        except Exception as err:
+                            if not self.args.keep_going:
+                                raise
+
+                            # Keep going, the previous output is kept
+                            self.keep_previous(self.page_destdir(fp, rr).joinpath(
+                                f'{basename}.html'))
+                            self.metrics.inc('pages_failed_total')
+                            failures.append((fp, err))
+                            continue
+
+                        self.metrics.inc('pages_rendered_total')
+                    elif self.primary:
+                        if fp.suffix not in ['.jinja2', '.yaml']:
+                            # Publish other files (in parallel)
+                            self.publish_asset(fp, os.path.join(rr, fp.name))
+
+            if target_langs and self.primary:
+                # At least one target language. Write the main index to redirect
+                # to the default language
 
-                        else:
-                            ddest = ddest_def
+                self.write_redirect(self.outdirp.joinpath('index.html'),
+                                    f'{self.lang_default.pt1}/')
 
-                        dom, _lang, dest = self.process_file(fp, destdir_root=ddest)
+            self.wait_assets()
 
-                        if dom_layout and len(blocks) > 0:
-                            for node in dom.iter():
-                                if node.name.startswith('block_'):
-                                    blk = findblock(node.name)
+            if self.args.fingerprint and self.primary:
+                self.write_asset_manifest()
+        except Exception:
+            traceback.print_exc()
+            self.assets.shutdown()
+            self.finish_staging(False)
+            return 1
+        else:
+            self.assets.shutdown()
+            self.purge_stale()
 
-                                    if blk is None or blk.parentNode is None:
-                                        continue
+            if self.shard:
+                write_manifest(self.outdirp, *self.shard, self.outputs,
+                               failures=len(failures))
 
-                                    # Replace the node
-                                    blk.parentNode.replaceChild(
-                                        node.firstChild, blk)
+            self.finish_staging(True)
 
-                        dom_target = dom_layout if dom_layout else dom
+            if self.build_cache:
+                print(f'Build cache: {self.build_cache.hits} of '
+                      f'{self.build_cache.lookups} page(s) reused',
+                      file=sys.stderr)
 
-                        if not dom_target:
-                            raise Exception('Empty DOM')
+            if failures:
+                print(f'{len(failures)} page(s) failed to render:',
+                      file=sys.stderr)
 
-                        self.output_dom(dom_target, dest=dest)
+                for fp, err in failures:
+                    if isinstance(err, PageError):
+                        print(f'  {err}', file=sys.stderr)
                     else:
-                        if fp.suffix not in ['.jinja2', '.yaml']:
-                            # Copy other files
-                            shutil.copy(fp, str(ddest_def))
+                        print(f'  {fp}: {err}', file=sys.stderr)
 
-            if target_langs:
-                # At least one target language. Write the main index to redirect
-                # to the default language
+            cid, deployed = None, False
 
-                redir = OmegaConf.create({
-                    'head': {
-                        'meta': [{
-                            '_http-equiv': 'Refresh',
-                            '_content': f'0; url={self.lang_default.pt1}/'
-                        }]
-                    }
-                })
-
-                dom, _l, dest = self.process_file(
-                    redir, destdir_root=self.outdirp,
-                    basename='index',
-                    i18n_out=False
-                )
+            if self.shard:
+                # The shards are combined with merge
+                return 3 if failures else 0
+            elif self.command in ['cid', 'export-car']:
+                if self.command == 'cid':
+                    cid = self.local_cid(self.outdirp)
+                else:
+                    cid = self.car_export()
 
-                self.output_dom(dom, dest=dest)
-        except Exception:
-            traceback.print_exc()
-            return 1
-        else:
-            cid = None
+                if cid:
+                    print(cid, file=sys.stdout)
 
-            if self.sitecfg.c.ipfs_output or self.command == 'ipfs-deploy':
-                cid = self.ipfs_add(str(self.outdirp))
+                return 1 if not cid else 3 if failures else 0
+            elif self.sitecfg.c.ipfs_output or self.command == 'ipfs-deploy':
+                local = self.local_cid(self.outdirp)
+
+                if self.args.reproducible and local and \
+                        local == self.last_deploy():
+                    # Nothing changed: no add, pin or publish
+                    self.metrics.inc('deploys_skipped_total')
+                    print(f'Unchanged since the last deploy: {local}',
+                          file=sys.stderr)
+                    print(local, file=sys.stdout)
+                    return 3 if failures else 0
+
+                cid = self.ipfs_add_site(local_cid=local)
 
                 if cid:
                     rps = self.get_target_rps()
@@ -698,32 +1388,46 @@ class Iraty:
                         # Pin to remote service
                         if self.ipfs_pinremote(rps, cid):
                             print(cid, file=sys.stdout)
+                            deployed = True
                     else:
                         print(cid, file=sys.stdout)
+                        deployed = True
             else:
                 if self.args.httpserve or self.command == 'serve':
                     return http_serve(self.outdirp,
                                       port=self.sitecfg.c.http_serve_port)
                 else:
                     for root, dirs, files in os.walk(str(self.outdirp)):
+                        if self.args.reproducible:
+                            dirs.sort()
+                            files.sort()
+
                         for file in files:
                             print(os.path.join(root, file), file=sys.stdout)
 
             if cid:
-                self.ipns_publish(cid)
+                published = self.ipns_publish(cid)
 
-        return 0
+                if deployed and published:
+                    # Added, pinned and published
+                    self.record_deploy(cid)
+
+        return 3 if failures else 0
 
     def ipns_genkey(self, name: str, type: str = 'ed25519'):
         return self.iclient.key.gen(name, type)
 
     def ipns_publish(self, cid):
+        """
+        Publish cid to the IPNS key (if one is set, the key is created if
+        necessary). Returns True if the record was published.
+        """
         pk_id = None
         kn = self.args.ipns_key_name
         kid = self.args.ipns_key_id
 
         if not kn and not kid:
-            return
+            return False
 
         res = self.iclient.key.list()
 
@@ -741,19 +1445,22 @@ class Iraty:
         if not pk_id and kn:
             key = self.ipns_genkey(kn)
             pk_id = key['Id']
-        elif pk_id:
-            # Publish
-            for att in range(0, 3):
-                try:
+        elif not pk_id:
+            raise Exception('Inexistent key. Please specify a key name with --ipns-name')
+
+        # Publish
+        for att in range(0, 3):
+            try:
+                with self.metrics.timed('publish'):
                     resp = self.iclient.name.publish(cid, key=pk_id)
-                    key = resp['Name']
+                key = resp['Name']
 
-                    print(f'/ipns/{key}', file=sys.stdout)
-                    break
-                except Exception as err:
-                    print(f'Error publishing to {pk_id}: {err}', file=sys.stderr)
-        else:
-            raise Exception('Inexistent key. Please specify a key name with --ipns-name')
+                print(f'/ipns/{key}', file=sys.stdout)
+                return True
+            except Exception as err:
+                print(f'Error publishing to {pk_id}: {err}', file=sys.stderr)
+
+        return False
 
 
 def list_themes():
@@ -800,36 +1507,6 @@ def list_resolvers():
         print(help)
 
 
-def lint(args):
-    from .config import default_lint_config
-    try:
-        from yamllint import linter
-        from yamllint.config import YamlLintConfig
-    except ImportError:
-        print('The yamllint library is missing', file=sys.stderr)
-        return 1
-
-    cfg = YamlLintConfig(default_lint_config)
-    errc = 0
-
-    for root, dirs, files in os.walk(Path(args.input[0])):
-        for file in files:
-            if not file.endswith('.yaml') or file == '.iraty.yaml':
-                continue
-
-            fp = Path(root).joinpath(file)
-
-            with open(fp, 'rt') as fd:
-                errs = linter.run(fd, cfg)
-
-                for err in errs:
-                    print(f'({fp}): {err}', file=sys.stderr)
-
-                    errc += 1
-
-    return 0 if errc == 0 else 2
-
-
 def iraty(args):
     config_dir = Path(appdirs.user_config_dir('iraty'))
     config_dir.mkdir(parents=True, exist_ok=True)
@@ -892,6 +1569,33 @@ def iraty(args):
 
         sys.exit(0)
 
+    httpclient.configure(timeout=args.http_timeout,
+                         max_size_mib=args.http_max_size)
+
+    if command in ['render-server', 'batch'] and not args.input:
+        # Templates and includes are looked up from the current directory
+        args.input = ['.']
+
+    if command == 'merge':
+        try:
+            sys.exit(merge(Path(args.outdir),
+                           [Path(p) for p in args.input],
+                           mode=args.asset_mode))
+        except ShardError as err:
+            print(str(err), file=sys.stderr)
+            sys.exit(1)
+
+    if args.shard:
+        try:
+            parse_shard(args.shard)
+        except ShardError as err:
+            print(str(err), file=sys.stderr)
+            sys.exit(1)
+
+    if command == 'serve' and args.from_car:
+        # Serve the DAG of a CAR file (no build)
+        sys.exit(car_serve(Path(args.from_car), port=args.httpport))
+
     if len(args.input) != 1:
         print('Invalid input arguments', file=sys.stderr)
         sys.exit(1)
@@ -911,29 +1615,48 @@ def iraty(args):
         # Should be fatal ?
         iclient = None
         print(f'IPFS connection Error: {err}', file=sys.stderr)
-    else:
-        # Set global client
-        resolvers.ipfs_client = iclient
 
     input_path = Path(filein)
+
+    if command == 'check':
+        if not input_path.exists():
+            print(f'{input_path} does not exist', file=sys.stderr)
+            sys.exit(1)
+
+        theme_name = os.path.basename(args.theme)
+        sys.exit(check(input_path, build_context(input_path, iclient),
+                       assets=[f'{theme_name}.css', 'lang-selector.css'],
+                       jobs=args.jobs))
+
     ira = Iraty(command, input_path, iclient, node_cfg, args)
     ira.start()
 
+    if command == 'render-server':
+        rc = render_serve(ira, listen=args.listen, jobs=args.jobs)
+        ira.dump_metrics()
+        sys.exit(rc)
+    elif command == 'batch':
+        rc = batch(ira, output='ipfs' if args.ipfsout else args.batch_output,
+                   jobs=args.jobs, null=args.null_input)
+        ira.dump_metrics()
+        sys.exit(rc)
+
     if not input_path.exists():
         print(f'{input_path} does not exist', file=sys.stderr)
         sys.exit(1)
 
+    if command == 'serve' and args.lazy and input_path.is_dir():
+        rc = lazy_serve(ira, input_path, port=ira.sitecfg.c.http_serve_port,
+                        live_reload=args.live_reload)
+        ira.finish_staging(False)
+        ira.dump_metrics()
+        sys.exit(rc)
+
     if input_path.is_file():
-        resolvers.root_input_path = input_path.parent
-        jenv.loader = FileSystemLoader(str(input_path.parent))
         _dom, _l, _p = ira.process_file(input_path, destdir_root=Path('.'), output=True)
+        ira.dump_metrics()
         sys.exit(0 if _dom else 1)
     elif input_path.is_dir():
-        resolvers.root_input_path = input_path
-        jenv.loader = FileSystemLoader([
-            str(input_path),
-            str(input_path.joinpath('templates')),
-            str(assets_root.joinpath('jinja2')),
-        ])
-
-        sys.exit(ira.process_directory(input_path))
+        rc = ira.process_directory(input_path)
+        ira.dump_metrics()
+        sys.exit(rc)
@@ -0,0 +1,121 @@
+import hashlib
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from .cache import JsonCache
+from .cache import file_stamp
+from .config import default_lint_config
+
+
+lint_suffixes = ['.yaml', '.yml']
+lint_ignore = ['.iraty.yaml']
+
+# yamllint config (per process)
+_lint_cfg = None
+
+
+def lintable(name: str):
+    return os.path.splitext(name)[1] in lint_suffixes and \
+        name not in lint_ignore
+
+
+def lint_config_hash():
+    import yamllint
+
+    h = hashlib.sha256(default_lint_config.encode())
+    h.update(yamllint.__version__.encode())
+    return h.hexdigest()
+
+
+def lint_inputs(inputs: list):
+    """
+    Yield the paths of the YAML files to lint (inputs can be files or
+    directories, layout files are included)
+    """
+    for inp in inputs:
+        path = Path(inp)
+
+        if path.is_dir():
+            for root, dirs, files in os.walk(path):
+                for file in files:
+                    if lintable(file):
+                        yield Path(root).joinpath(file)
+        elif path.is_file() and lintable(path.name):
+            yield path
+
+
+def lint_file(path: Path):
+    """
+    Lint a single file, returns the list of problems (as strings)
+    """
+    global _lint_cfg
+
+    from yamllint import linter
+    from yamllint.config import YamlLintConfig
+
+    if _lint_cfg is None:
+        _lint_cfg = YamlLintConfig(default_lint_config)
+
+    with open(path, 'rt') as fd:
+        return [str(err) for err in linter.run(fd, _lint_cfg)]
+
+
+def lint(args):
+    try:
+        import yamllint  # noqa
+    except ImportError:
+        print('The yamllint library is missing', file=sys.stderr)
+        return 1
+
+    if not args.input:
+        print('Please specify files or directories to lint', file=sys.stderr)
+        return 1
+
+    cache = JsonCache('lint-cache')
+    cfg_hash = lint_config_hash()
+    todo, stamps = [], {}
+    errc = 0
+
+    if args.lint_cache:
+        cache.load()
+
+    for fp in sorted(set(lint_inputs(args.input))):
+        key = str(fp.resolve())
+        stamp = list(file_stamp(fp)) + [cfg_hash]
+
+        if cache.get(key) == stamp:
+            # Unchanged since the last clean run
+            continue
+
+        todo.append(fp)
+        stamps[fp] = key, stamp
+
+    jobs = args.jobs if args.jobs else os.cpu_count()
+
+    if jobs > 1 and len(todo) > 1:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(todo))) as pool:
+            results = pool.map(lint_file, todo,
+                               chunksize=max(1, len(todo) // (jobs * 4)))
+            results = list(results)
+    else:
+        results = [lint_file(fp) for fp in todo]
+
+    for fp, errs in zip(todo, results):
+        key, stamp = stamps[fp]
+
+        for err in errs:
+            print(f'({fp}): {err}', file=sys.stderr)
+
+            errc += 1
+
+        if errs:
+            cache.pop(key)
+        else:
+            cache.set(key, stamp)
+
+    if args.lint_cache:
+        cache.save()
+
+    return 0 if errc == 0 else 2
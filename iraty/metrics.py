@@ -0,0 +1,216 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+
+# Default histogram buckets (seconds), same as the prometheus client libs
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+metric_formats = ['jsonl', 'prometheus']
+
+
+def labels_key(labels: dict):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def labels_prom(lkey: tuple, extra: tuple = ()):
+    pairs = list(lkey) + list(extra)
+
+    if not pairs:
+        return ''
+
+    def esc(v):
+        return v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    return '{' + ','.join(f'{k}="{esc(v)}"' for k, v in pairs) + '}'
+
+
+class Histogram:
+    def __init__(self, buckets=default_buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[idx] += 1
+                break
+
+    def cumulative(self):
+        total, cum = 0, []
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            cum.append((bound, total))
+        return cum
+
+
+class Metrics:
+    """
+    Collects the counters and histograms of a build.
+
+    Metric names are prefixed with "iraty_", labels are passed as
+    keyword arguments:
+
+    metrics.inc('pages_rendered_total')
+    metrics.observe('stage_duration_seconds', 0.3, stage='add')
+    """
+
+    prefix = 'iraty_'
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name: str, value=1, **labels):
+        key = (name, labels_key(labels))
+
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, labels_key(labels))
+
+        with self.lock:
+            hist = self.histograms.get(key)
+            if not hist:
+                hist = self.histograms[key] = Histogram()
+
+            hist.observe(value)
+
+    def error(self, stage: str):
+        self.inc('errors_total', stage=stage)
+
+    def cache(self, cache: str, hit: bool, count: int = 1):
+        self.inc('cache_requests_total', count, cache=cache,
+                 result='hit' if hit else 'miss')
+
+    @contextmanager
+    def timed(self, stage: str):
+        """
+        Measure the duration of a stage. An exception raised from the
+        block is counted as an error for that stage.
+        """
+        start = time.monotonic()
+        try:
+            yield
+        except Exception:
+            self.error(stage)
+            raise
+        finally:
+            self.observe('stage_duration_seconds',
+                         time.monotonic() - start, stage=stage)
+
+    def cache_hit_rates(self):
+        caches = {}
+        for (name, lkey), value in self.counters.items():
+            if name != 'cache_requests_total':
+                continue
+
+            labels = dict(lkey)
+            hits, total = caches.get(labels['cache'], (0, 0))
+            if labels['result'] == 'hit':
+                hits += value
+            caches[labels['cache']] = (hits, total + value)
+
+        return {cache: hits / total for cache, (hits, total) in caches.items()
+                if total > 0}
+
+    def jsonl(self, timestamp: float = None):
+        ts = timestamp if timestamp else time.time()
+
+        with self.lock:
+            for (name, lkey), value in sorted(self.counters.items()):
+                yield json.dumps({
+                    'ts': ts,
+                    'metric': self.prefix + name,
+                    'type': 'counter',
+                    'labels': dict(lkey),
+                    'value': value
+                })
+
+            for (name, lkey), hist in sorted(self.histograms.items()):
+                yield json.dumps({
+                    'ts': ts,
+                    'metric': self.prefix + name,
+                    'type': 'histogram',
+                    'labels': dict(lkey),
+                    'count': hist.count,
+                    'sum': hist.sum,
+                    'buckets': {str(b): c for b, c in hist.cumulative()}
+                })
+
+        for cache, rate in sorted(self.cache_hit_rates().items()):
+            yield json.dumps({
+                'ts': ts,
+                'metric': self.prefix + 'cache_hit_ratio',
+                'type': 'gauge',
+                'labels': {'cache': cache},
+                'value': rate
+            })
+
+    def prometheus(self):
+        lines = []
+        typed = set()
+
+        def header(name, mtype):
+            if name not in typed:
+                lines.append(f'# TYPE {name} {mtype}')
+                typed.add(name)
+
+        with self.lock:
+            for (name, lkey), value in sorted(self.counters.items()):
+                fname = self.prefix + name
+                header(fname, 'counter')
+                lines.append(f'{fname}{labels_prom(lkey)} {value}')
+
+            for (name, lkey), hist in sorted(self.histograms.items()):
+                fname = self.prefix + name
+                header(fname, 'histogram')
+
+                for bound, count in hist.cumulative():
+                    lines.append(
+                        f'{fname}_bucket{labels_prom(lkey, (("le", str(bound)),))} '
+                        f'{count}')
+
+                lines.append(
+                    f'{fname}_bucket{labels_prom(lkey, (("le", "+Inf"),))} '
+                    f'{hist.count}')
+                lines.append(f'{fname}_sum{labels_prom(lkey)} {hist.sum}')
+                lines.append(f'{fname}_count{labels_prom(lkey)} {hist.count}')
+
+        for cache, rate in sorted(self.cache_hit_rates().items()):
+            fname = self.prefix + 'cache_hit_ratio'
+            header(fname, 'gauge')
+            lines.append(f'{fname}{labels_prom((("cache", cache),))} {rate}')
+
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path: Path, fmt: str = 'jsonl'):
+        """
+        Write the metrics to a file. JSON lines are appended (one
+        batch per build), the prometheus text file is replaced atomically
+        (suitable for node_exporter's textfile collector).
+        """
+        if fmt == 'prometheus':
+            tmp = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+
+            with open(tmp, 'wt') as fd:
+                fd.write(self.prometheus())
+
+            os.replace(tmp, path)
+        elif fmt == 'jsonl':
+            with open(path, 'at') as fd:
+                for line in self.jsonl():
+                    fd.write(line + '\n')
+        else:
+            raise ValueError(f'Unknown metrics format: {fmt}')
@@ -1,16 +1,84 @@
+import io
+import re
+
+import yaml
 from omegaconf import DictConfig
 from omegaconf import ListConfig
+from omegaconf import OmegaConf
+
+try:
+    from yaml import CSafeLoader as BaseLoader
+except ImportError:
+    from yaml import SafeLoader as BaseLoader
+
+
+class PlainLoader(BaseLoader):
+    """
+    YAML loader for documents without interpolations, which loads the
+    same values as OmegaConf's loader (no timestamps, YAML 1.2 floats,
+    duplicate keys are an error)
+    """
+
+    def construct_mapping(self, node, deep=False):
+        keys = set()
+
+        for key_node, value_node in node.value:
+            if key_node.tag != yaml.resolver.BaseResolver.DEFAULT_SCALAR_TAG:
+                continue
+
+            if key_node.value in keys:
+                raise yaml.constructor.ConstructorError(
+                    'while constructing a mapping', node.start_mark,
+                    f'found duplicate key {key_node.value}',
+                    key_node.start_mark)
+
+            keys.add(key_node.value)
+
+        return super().construct_mapping(node, deep=deep)
+
+
+PlainLoader.add_implicit_resolver(
+    'tag:yaml.org,2002:float',
+    re.compile(r"""^(?:
+     [-+]?[0-9]+(?:_[0-9]+)*\.[0-9_]*(?:[eE][-+]?[0-9]+)?
+    |[-+]?[0-9]+(?:_[0-9]+)*(?:[eE][-+]?[0-9]+)
+    |\.[0-9]+(?:_[0-9]+)*(?:[eE][-+][0-9]+)?
+    |[-+]?[0-9]+(?:_[0-9]+)*(?::[0-5]?[0-9])+\.[0-9_]*
+    |[-+]?\.(?:inf|Inf|INF)
+    |\.(?:nan|NaN|NAN))$""", re.X),
+    list('-+0123456789.'))
+
+PlainLoader.yaml_implicit_resolvers = {
+    key: [(tag, regexp) for tag, regexp in resolvers
+          if tag != 'tag:yaml.org,2002:timestamp']
+    for key, resolvers in PlainLoader.yaml_implicit_resolvers.items()
+}
+
+
+def load_document(fd):
+    """
+    Load a YAML document. Documents without interpolations are loaded as
+    plain dicts and lists (much faster than going through OmegaConf),
+    otherwise a DictConfig is returned.
+    """
+    text = fd.read()
+
+    if '${' in text:
+        return OmegaConf.load(io.StringIO(text))
+
+    doc = yaml.load(text, Loader=PlainLoader)
+    return doc if doc is not None else {}
 
 
 def shove(target, c, pos='last'):
     dst = None
 
-    if isinstance(target, DictConfig):
+    if isinstance(target, (DictConfig, dict)):
         if '...' not in target:
             target['...'] = []
 
         dst = target['...']
-    elif isinstance(target, ListConfig):
+    elif isinstance(target, (ListConfig, list)):
         dst = target
     else:
         return
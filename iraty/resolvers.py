@@ -1,27 +1,77 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
 import base64
+import collections
+import contextlib
+import copy
+import functools
 import sys
-import urllib.request
+import threading
+import time
 import hashlib
+import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 
 from datetime import datetime
 
 from omegaconf import OmegaConf
+from omegaconf import Container
+from omegaconf import DictConfig
+from omegaconf import ListConfig
 
+from . import httpclient
+from .context import current
 
-# Global
-ipfs_client = None
-root_path = None
-search_paths = None
+# How long (in seconds) the resolution of an IPNS path is cached for
+ipns_ls_ttl = 300
+
+# Rounds of async resolution (see resolve())
+async_max_rounds = 8
+
+# State of the resolve() pass running in the current thread
+_resolving = threading.local()
+
+# Prefix of the placeholders of the pending async calls
+pending_mark = '\0pending:'
+_io_executor = None
+
+# Resolver kinds: pure resolvers always return the same value for the
+# same arguments, build-constant resolvers return the same value during
+# a build (memoized in the build context), volatile resolvers are called
+# every time
+PURE = 'pure'
+BUILD = 'build'
+VOLATILE = 'volatile'
+
+# Memoized results of the pure resolvers: (name, args) -> value
+memo_max_size = 4096
+
+# Kind of each registered resolver
+kinds = {}
+_memo = collections.OrderedDict()
+_memo_lock = threading.Lock()
+
+# UnixFS listings: key -> (entries, complete)
+_ls_cache = {}
+_ls_ipns = {}
+_ls_lock = threading.Lock()
 
 
 class Irate(Exception):
     pass
 
 
+class Pending(Exception):
+    """
+    Raised by a resolver called with the placeholder of an async call
+    that has not been awaited yet (it will be called again with the
+    result)
+    """
+
+
 def include(path: str):
     """
     Include another YAML file and render it.
@@ -36,6 +86,7 @@ def include(path: str):
     """
 
     try:
+        root_path = current().root_path
         assert root_path is not None
 
         fp = root_path.joinpath(path)
@@ -53,10 +104,7 @@ def cat_raw(u: str):
         url = urlparse(u)
 
         if url.scheme in ['http', 'https']:
-            with urllib.request.urlopen(u) as response:
-                data = response.read()
-
-            return data
+            return httpclient.get_client().get(u)
         elif url.scheme in ['ipfs', 'ipns'] or not url.scheme:
             # ipfs:// or ipns:// raw cid/path
 
@@ -67,7 +115,7 @@ def cat_raw(u: str):
             else:
                 path = u
 
-            data = ipfs_client.cat(path)
+            data = current().ipfs_client.cat(path)
             return data
     except Exception as err:
         print(f'cat({u}) error: {err}', file=sys.stderr)
@@ -75,7 +123,7 @@ def cat_raw(u: str):
         raise Irate(err)
 
 
-def cat(url: str):
+async def cat(url: str):
     """
     Returns the contents (as string) of the requested resource.
 
@@ -88,13 +136,13 @@ def cat(url: str):
     p: ${cat:ipns://ipfs.io/index.html}
     """
 
-    data = cat_raw(url)
+    data = await blocking(cat_raw, url)
 
     assert isinstance(data, bytes)
     return data.decode()
 
 
-def cat64(url: str):
+async def cat64(url: str):
     """
     Returns the base64-encoded content (as string) of the requested resource.
 
@@ -108,13 +156,43 @@ def cat64(url: str):
     p: ${cat64:ipns://ipfs.io}
     """
 
-    data = cat_raw(url)
+    data = await blocking(cat_raw, url)
 
     assert isinstance(data, bytes)
     return base64.b64encode(data).decode()
 
 
-def csum_hex(algo: str, url: str):
+def checksum(algo: str, url: str):
+    if algo not in hashlib.algorithms_guaranteed:
+        raise Irate(f'Algorithm {algo} is not supported')
+
+    h = hashlib.new(algo)
+
+    if urlparse(url).scheme in ['http', 'https']:
+        # Hash the body as it's streamed
+        size = 0
+
+        try:
+            for chunk in httpclient.get_client().iter_content(url):
+                h.update(chunk)
+                size += len(chunk)
+        except Exception as err:
+            print(f'csum_hex({url}) error: {err}', file=sys.stderr)
+            raise Irate(err)
+    else:
+        data = cat_raw(url)
+        size = len(data) if data else 0
+
+        if data:
+            h.update(data)
+
+    if size > 0:
+        return h.hexdigest()
+    else:
+        raise Irate(f'Empty object: {url}')
+
+
+async def csum_hex(algo: str, url: str):
     """
     Returns the hexadecimal checksum of a remote or local file for the
     specified hashing algorithm.
@@ -129,18 +207,7 @@ def csum_hex(algo: str, url: str):
     span: ${csum_hex:sha512,bafkreihszin3nr7ja7ig3l7enb7fph6oo2zx4tutw5qfaiw2kltmzqtp2i}
     """
 
-    if algo not in hashlib.algorithms_guaranteed:
-        raise Irate(f'Algorithm {algo} is not supported')
-
-    h = hashlib.new(algo)
-
-    data = cat_raw(url)
-
-    if data:
-        h.update(data)
-        return h.hexdigest()
-    else:
-        raise Irate(f'Empty object: {url}')
+    return await blocking(checksum, algo, url)
 
 
 def cssl(href: str):
@@ -203,10 +270,130 @@ def toc(scope: str, depth: int = 0,
     })
 
 
-def unixfs_ls(path: str,
-              regex: str,
-              gwurl: str = 'https://dweb.link',
-              limit: int = 0):
+def ipfs_path(path: str):
+    """
+    Convert ipfs:// and ipns:// URLs to IPFS paths
+    """
+    for scheme in ['ipfs', 'ipns']:
+        if path.startswith(f'{scheme}://'):
+            return f'/{scheme}/{path[len(scheme) + 3:]}'
+
+    return path
+
+
+def unixfs_entries(path: str):
+    """
+    Iterate over the (name, cid) entries of a UnixFS directory. The
+    listing is streamed from the IPFS node, and stops as soon as the
+    caller stops iterating (close the generator).
+
+    Listings are cached with the CID of the directory as key (/ipns/
+    paths are resolved to this CID, and the resolution is cached for
+    ipns_ls_ttl seconds). Partial listings are resumed if more entries
+    are needed.
+    """
+    path = ipfs_path(path)
+    ipns = path.startswith('/ipns/')
+
+    with _ls_lock:
+        if ipns:
+            key, expires = _ls_ipns.get(path, (None, 0))
+            if expires < time.monotonic():
+                key = None
+        else:
+            key = path
+
+        entries, complete = _ls_cache.get(key, ([], False))
+        entries = list(entries)
+
+    ctx = current()
+
+    if ctx.metrics is not None:
+        ctx.metrics.cache('unixfs_ls', key in _ls_cache)
+
+    yield from entries
+
+    if complete:
+        return
+
+    # Resume from the directory's CID if it's known
+    skip, dirkey = len(entries), key
+    opts = {'stream': 'true', 'resolve-type': 'false', 'size': 'false'}
+    listing = ctx.ipfs_client.ls(key if key else path, opts=opts,
+                                 stream=True)
+
+    try:
+        for resp in listing:
+            for obj in resp['Objects']:
+                if not dirkey:
+                    dirkey = f"/ipfs/{obj['Hash']}"
+
+                for link in obj['Links']:
+                    if skip > 0:
+                        skip -= 1
+                        continue
+
+                    entries.append((link['Name'], link['Hash']))
+                    yield entries[-1]
+
+        complete = True
+    finally:
+        listing.close()
+
+        if dirkey:
+            with _ls_lock:
+                cached, _c = _ls_cache.get(dirkey, ([], False))
+
+                if complete or len(entries) > len(cached):
+                    _ls_cache[dirkey] = (entries, complete)
+
+                if ipns:
+                    _ls_ipns[path] = (dirkey,
+                                      time.monotonic() + ipns_ls_ttl)
+
+
+def unixfs_listing(path: str, regex: str, gwurl: str, limit: int):
+    node = {'ul': []}
+
+    try:
+        count = 0
+        pattern = re.compile(regex)
+
+        with contextlib.closing(unixfs_entries(path)) as entries:
+            for name, cid in entries:
+                if not pattern.search(name):
+                    continue
+
+                if gwurl == 'ipfs' and 0:
+                    # TODO: handle CIDv0 conversion without using a 3rd-party lib
+                    href = f'ipfs://{cid}'
+                elif gwurl.startswith('https'):
+                    href = f'{gwurl}/ipfs/{cid}'
+                elif not gwurl:
+                    href = f'https://dweb.link/ipfs/{cid}'
+
+                node['ul'].append({
+                    'li': {
+                        'a': {
+                            '_href': href,
+                            '_': name
+                        }
+                    }
+                })
+                count += 1
+
+                if limit > 0 and count >= limit:
+                    break
+    except Exception as err:
+        print(f'unixfs_ls({path}) error: {err}', file=sys.stderr)
+
+    return node
+
+
+async def unixfs_ls(path: str,
+                    regex: str,
+                    gwurl: str = 'https://dweb.link',
+                    limit: int = 0):
     """
     Generate a listing of a UnixFS directory, rendering it as an HTML
     list.
@@ -222,54 +409,319 @@ def unixfs_ls(path: str,
     .: ${unixfs_ls:/ipns/dist.ipfs.io, .*, 'https://ipfs.io', 0}
     """
 
-    node = {'ul': []}
+    return await blocking(unixfs_listing, path, regex, gwurl, limit)
+
+
+def io_executor():
+    global _io_executor
+
+    with _ls_lock:
+        if _io_executor is None:
+            _io_executor = ThreadPoolExecutor(
+                max_workers=min(32, (os.cpu_count() or 1) + 4),
+                thread_name_prefix='resolver')
+
+        return _io_executor
+
+
+async def blocking(fn, *args):
+    """
+    Run a blocking function (I/O) in the resolvers' thread pool (with
+    the current build context)
+    """
+    ctx = current()
+
+    def run():
+        with ctx.activate():
+            return fn(*args)
+
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(io_executor(), run)
+
+
+def run_coroutine(coro):
+    loop = asyncio.new_event_loop()
 
     try:
-        count = 0
-        listing = ipfs_client.ls(path)
-
-        for entry in listing['Objects'].pop()['Links']:
-            if limit > 0 and count >= limit:
-                break
-
-            cid = entry['Hash']
-
-            match = re.search(rf'{regex}', entry['Name'])
-            if not match:
-                continue
-
-            if gwurl == 'ipfs' and 0:
-                # TODO: handle CIDv0 conversion without using a 3rd-party lib
-                href = f'ipfs://{cid}'
-            elif gwurl.startswith('https'):
-                href = f'{gwurl}/ipfs/{cid}'
-            elif not gwurl:
-                href = f'https://dweb.link/ipfs/{cid}'
-
-            node['ul'].append({
-                'li': {
-                    'a': {
-                        '_href': href,
-                        '_': entry['Name']
-                    }
-                }
-            })
-            count += 1
-    except Exception as err:
-        print(f'unixfs_ls({path}) error: {err}', file=sys.stderr)
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
 
-    return node
 
+async def gather_pending(pending: dict):
+    """
+    Await the pending async resolver calls concurrently. Exceptions are
+    returned as results (and raised when the result is used).
+    """
+    keys = list(pending.keys())
+    values = await asyncio.gather(*[pending[key]() for key in keys],
+                                  return_exceptions=True)
+    return dict(zip(keys, values))
+
+
+def call_async(name: str, fn, args):
+    """
+    Call an async resolver. Within resolve(), the first passes only
+    collect the calls (returning a placeholder), and the results are
+    substituted once they have been awaited.
+    """
+    results = getattr(_resolving, 'results', None)
+
+    if results is None:
+        # Outside of resolve(), run it now
+        return run_coroutine(fn(*args))
+
+    key = (name, repr(args))
+
+    if key in results:
+        value = results[key]
+
+        if isinstance(value, BaseException):
+            raise value
+
+        return value
+
+    _resolving.pending.setdefault(key, functools.partial(fn, *args))
+    return f'{pending_mark}{name}'
+
+
+def has_placeholder(value):
+    """
+    True if value (a resolver argument) contains the placeholder of a
+    pending async call
+    """
+    if isinstance(value, str):
+        return pending_mark in value
+    elif isinstance(value, (list, tuple, ListConfig)):
+        return any(has_placeholder(v) for v in value)
+    elif isinstance(value, (dict, DictConfig)):
+        return any(has_placeholder(v) for v in value.values())
+
+    return False
+
+
+def resolve(cfg):
+    """
+    Resolve a config, like OmegaConf.to_container(cfg, resolve=True),
+    awaiting the async resolvers (like cat) concurrently.
+
+    The config is resolved once to collect the async resolver calls, which
+    are then run on an event loop, and resolved again with the results.
+    This is repeated if resolving with the results gives new async
+    calls (nested interpolations).
+
+    Plain containers (documents without interpolations) are returned
+    as is.
+    """
+    metrics = current().metrics
+
+    if not isinstance(cfg, Container):
+        if metrics is not None:
+            metrics.inc('documents_total', loader='plain')
+
+        return cfg
+
+    if metrics is not None:
+        metrics.inc('documents_total', loader='omegaconf')
+
+    if getattr(_resolving, 'results', None) is not None:
+        # Nested call (include), part of the current resolution
+        return OmegaConf.to_container(cfg, resolve=True)
+
+    results = {}
+
+    try:
+        for attempt in range(async_max_rounds):
+            _resolving.results, _resolving.pending = results, {}
+
+            try:
+                container = OmegaConf.to_container(cfg, resolve=True)
+            except Exception:
+                # Resolvers depending on pending async calls raise Pending
+                if not _resolving.pending:
+                    raise
+            else:
+                if not _resolving.pending:
+                    return container
+
+            results.update(run_coroutine(
+                gather_pending(_resolving.pending)))
+    finally:
+        _resolving.results, _resolving.pending = None, None
 
-OmegaConf.register_new_resolver("block", block)
-OmegaConf.register_new_resolver("csum_hex", csum_hex)
-OmegaConf.register_new_resolver("cssl", cssl)
-OmegaConf.register_new_resolver("include", include)
-OmegaConf.register_new_resolver("unixfs_ls", unixfs_ls)
-OmegaConf.register_new_resolver("cat", cat)
-OmegaConf.register_new_resolver("cat64", cat64)
-OmegaConf.register_new_resolver(
-    "dtnow_iso",
-    lambda: datetime.now().isoformat(timespec='seconds', sep=' '))
-OmegaConf.register_new_resolver("toc", toc)
-OmegaConf.register_new_resolver("lang_selector", lang_selector)
+    raise Irate('Too many rounds of async resolution')
+
+
+def memoized(name: str, kind: str, fn):
+    """
+    Wrap a pure or build-constant resolver, memoizing its results by
+    arguments (pure results are shared by all builds, build-constant
+    results are stored in the build context). The least recently used
+    results are evicted. Configs are memoized as plain containers, and
+    each call gets its own copy.
+    """
+
+    def thaw(entry):
+        is_config, value = entry
+
+        if is_config:
+            return OmegaConf.create(value)
+        elif isinstance(value, (dict, list)):
+            return copy.deepcopy(value)
+
+        return value
+
+    @functools.wraps(fn)
+    def wrapper(*args):
+        key = (name, repr(args))
+        ctx = current()
+
+        if kind == BUILD:
+            memo, lock = ctx.memo, ctx.memo_lock
+        else:
+            memo, lock = _memo, _memo_lock
+
+        with lock:
+            entry = memo.get(key)
+
+            if entry is not None:
+                memo.move_to_end(key)
+
+        if ctx.metrics is not None:
+            ctx.metrics.cache(f'resolver_{name}', entry is not None)
+
+        if entry is not None:
+            return thaw(entry)
+
+        value = fn(*args)
+
+        if isinstance(value, Container):
+            entry = (True, OmegaConf.to_container(value, resolve=False))
+        else:
+            entry = (False, value)
+
+        with lock:
+            memo[key] = entry
+            memo.move_to_end(key)
+
+            while len(memo) > memo_max_size:
+                memo.popitem(last=False)
+
+        return thaw(entry)
+
+    return wrapper
+
+
+def register(name: str, fn, kind: str = VOLATILE):
+    """
+    Register a resolver with OmegaConf, counting calls and measuring
+    durations when a metrics sink is set. Resolvers can be coroutine
+    functions (see resolve()).
+
+    kind is PURE, BUILD (build-constant) or VOLATILE (the default).
+    Results of pure and build-constant (synchronous) resolvers are
+    memoized.
+    """
+
+    def observe(metrics, start: float, failed: bool):
+        if failed:
+            metrics.error(f'resolver_{name}')
+
+        metrics.inc('resolver_calls_total', resolver=name)
+        metrics.observe('resolver_duration_seconds',
+                        time.monotonic() - start, resolver=name)
+
+    if asyncio.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def cached(*args):
+            # Results of content-addressed fetches are in the build cache
+            cache = current().build_cache
+            if cache is None:
+                return await fn(*args)
+
+            found, result = cache.result(name, args)
+            if found:
+                return result
+
+            result = await fn(*args)
+            cache.store_result(name, args, result)
+            return result
+
+        @functools.wraps(fn)
+        async def measured_async(*args):
+            metrics = current().metrics
+
+            if metrics is None:
+                return await cached(*args)
+
+            start, failed = time.monotonic(), True
+            try:
+                result = await cached(*args)
+                failed = False
+                return result
+            finally:
+                observe(metrics, start, failed)
+
+        def resolver(*args):
+            return call_async(name, measured_async, args)
+    else:
+        @functools.wraps(fn)
+        def resolver(*args, **kwargs):
+            metrics = current().metrics
+
+            if metrics is None:
+                return fn(*args, **kwargs)
+
+            start, failed = time.monotonic(), True
+            try:
+                result = fn(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                observe(metrics, start, failed)
+
+        if kind in [PURE, BUILD]:
+            resolver = memoized(name, kind, resolver)
+
+    def recorded(*args):
+        if getattr(_resolving, 'results', None) is not None and \
+                has_placeholder(args):
+            # Depends on a pending async call: not run, memoized or
+            # recorded until its result is known
+            raise Pending(name)
+
+        # Record the call (dependencies of the page, see buildcache)
+        calls = current().calls
+        if calls is not None:
+            calls.append((name, args))
+
+        return resolver(*args)
+
+    kinds[name] = kind
+    OmegaConf.register_new_resolver(name, recorded)
+
+
+def dtnow_iso():
+    """
+    Returns the current date and time (ISO 8601)
+
+    Example:
+
+    p: Current date and time ${dtnow_iso:}
+    """
+    now = current().build_time
+    now = now if now else datetime.now()
+
+    return now.isoformat(timespec='seconds', sep=' ')
+
+
+register("block", block, kind=PURE)
+register("csum_hex", csum_hex)
+register("cssl", cssl, kind=PURE)
+register("include", include, kind=BUILD)
+register("unixfs_ls", unixfs_ls)
+register("cat", cat)
+register("cat64", cat64)
+register("dtnow_iso", dtnow_iso, kind=BUILD)
+register("toc", toc, kind=PURE)
+register("lang_selector", lang_selector, kind=PURE)
@@ -0,0 +1,795 @@
+"""
+HTTP preview servers: serving the output directory, or rendering the
+pages on demand (lazy mode)
+"""
+
+import email.utils
+import functools
+import http.server
+import io
+import os
+import posixpath
+import queue
+import socketserver
+import sys
+import threading
+import time
+import uuid
+from pathlib import Path
+from urllib.parse import unquote
+from urllib.parse import urlsplit
+
+from .cache import file_stamp
+from .car import CarArchive
+from .car import InvalidCar
+from .unixfs import UnsupportedDag
+from .unixfs import cid_str
+from .unixfs import t_directory
+from .fsutil import publish_file
+from . import i18n
+
+
+assets_root = Path(os.path.dirname(__file__)).joinpath('assets')
+
+# Live reload: server-sent events endpoint and client script
+livereload_path = '/_iraty/events'
+livereload_script = b"""<script>(function() {
+  var es = new EventSource('%s');
+  var page = location.pathname.replace(/\\/$/, '/index.html');
+  es.addEventListener('reload', function(e) {
+    if (e.data === page) location.reload();
+  });
+  es.addEventListener('css', function(e) {
+    document.querySelectorAll('link[rel=stylesheet]').forEach(function(l) {
+      var u = new URL(l.href);
+      if (u.pathname === e.data) {
+        u.searchParams.set('v', Date.now());
+        l.href = u.href;
+      }
+    });
+  });
+})();</script>""" % livereload_path.encode()
+
+
+class HTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def parse_ranges(header: str, size: int, max_ranges: int = 16):
+    """
+    Parse a Range header (bytes=...) for a file of the given size.
+    Returns the list of (first, last) byte positions, an empty list if
+    the ranges can't be satisfied, or None if the header is invalid (or
+    has too many ranges), in which case it's ignored.
+    """
+    unit, _, specs = header.partition('=')
+
+    if unit.strip() != 'bytes':
+        return None
+
+    specs = [spec.strip() for spec in specs.split(',') if spec.strip()]
+    if not specs or len(specs) > max_ranges:
+        return None
+
+    ranges = []
+    for spec in specs:
+        first, sep, last = spec.partition('-')
+
+        if not sep:
+            return None
+
+        try:
+            if not first:
+                # Suffix range: the last bytes
+                length = int(last)
+                if length > 0 and size > 0:
+                    ranges.append((max(size - length, 0), size - 1))
+                continue
+
+            first = int(first)
+            last = int(last) if last else None
+        except ValueError:
+            return None
+
+        if last is None:
+            last = size - 1
+        elif first > last:
+            return None
+
+        if first < size:
+            ranges.append((first, min(last, size - 1)))
+
+    return ranges
+
+
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    Serves files with support for conditional and range requests (single
+    and multiple ranges), sending the file bodies with sendfile()
+    """
+
+    ranges = None
+    boundary = None
+
+    def send_head(self):
+        self.ranges, self.boundary = None, None
+        path = self.translate_path(self.path)
+
+        if not os.path.isfile(path) or self.path.endswith('/'):
+            return super().send_head()
+
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            self.send_error(404, 'File not found')
+            return None
+
+        try:
+            fs = os.fstat(f.fileno())
+            return self.send_body(f, fs.st_size, self.guess_type(path),
+                                  etag=f'"{fs.st_mtime_ns:x}-{fs.st_size:x}"',
+                                  mtime=fs.st_mtime)
+        except Exception:
+            f.close()
+            raise
+
+    def send_body(self, f, size: int, ctype: str, etag: str,
+                  mtime: float = None, headers: dict = None):
+        """
+        Send the headers of the response for a body of size bytes (read
+        from f), handling conditional and range requests. Returns f, or
+        None (and closes f) if there's no body to send
+        """
+        lastmod = self.date_time_string(mtime) if mtime else None
+
+        if self.not_modified(etag, mtime):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            f.close()
+            return None
+
+        ranges = None
+        if 'Range' in self.headers and \
+                self.headers.get('If-Range', etag) in [etag, lastmod]:
+            ranges = parse_ranges(self.headers['Range'], size)
+
+        if ranges == []:
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{size}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            f.close()
+            return None
+
+        if ranges is None:
+            self.send_response(200)
+            self.send_header('Content-Type', ctype)
+            self.send_header('Content-Length', str(size))
+            self.ranges = [(0, size - 1)]
+        elif len(ranges) == 1:
+            first, last = ranges[0]
+            self.send_response(206)
+            self.send_header('Content-Type', ctype)
+            self.send_header('Content-Range', f'bytes {first}-{last}/{size}')
+            self.send_header('Content-Length', str(last - first + 1))
+            self.ranges = ranges
+        else:
+            self.boundary = uuid.uuid4().hex
+            self.parts = [self.part_header(ctype, first, last, size)
+                          for first, last in ranges]
+            length = sum(len(hdr) + last - first + 1 for hdr, (
+                first, last) in zip(self.parts, ranges))
+            length += len(self.part_end())
+
+            self.send_response(206)
+            self.send_header('Content-Type', 'multipart/byteranges; '
+                             f'boundary={self.boundary}')
+            self.send_header('Content-Length', str(length))
+            self.ranges = ranges
+
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+
+        if lastmod:
+            self.send_header('Last-Modified', lastmod)
+
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+
+        self.end_headers()
+        return f
+
+    def not_modified(self, etag: str, mtime: float = None):
+        inm = self.headers.get('If-None-Match')
+        if inm:
+            return etag in [tag.strip() for tag in inm.split(',')] or \
+                inm.strip() == '*'
+
+        ims = self.headers.get('If-Modified-Since')
+        if ims and mtime:
+            try:
+                since = email.utils.parsedate_to_datetime(ims)
+            except (TypeError, ValueError, IndexError, OverflowError):
+                return False
+
+            return since is not None and int(mtime) <= since.timestamp()
+
+        return False
+
+    def part_header(self, ctype: str, first: int, last: int, size: int):
+        return (f'\r\n--{self.boundary}\r\n'
+                f'Content-Type: {ctype}\r\n'
+                f'Content-Range: bytes {first}-{last}/{size}\r\n'
+                '\r\n').encode()
+
+    def part_end(self):
+        return f'\r\n--{self.boundary}--\r\n'.encode()
+
+    def copyfile(self, source, outputfile):
+        if not self.ranges:
+            return super().copyfile(source, outputfile)
+
+        for idx, (first, last) in enumerate(self.ranges):
+            if self.boundary:
+                outputfile.write(self.parts[idx])
+
+            self.sendfile(source, first, last - first + 1)
+
+        if self.boundary:
+            outputfile.write(self.part_end())
+
+    def sendfile(self, source, offset: int, count: int):
+        """
+        Send count bytes of the file from offset, without copying them
+        in userspace when the platform supports it
+        """
+        if count <= 0:
+            return
+
+        self.wfile.flush()
+
+        try:
+            self.connection.sendfile(source, offset, count)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+def http_serve(directory: Path, port=8000):
+    """
+    Serve via HTTP the specified directory on the given TCP port
+    """
+
+    Handler = functools.partial(
+        RangeRequestHandler,
+        directory=str(directory)
+    )
+
+    with HTTPServer(("", port), Handler) as httpd:
+        print(f'Serving via HTTP at: http://localhost:{port}', file=sys.stdout)
+
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            httpd.shutdown()
+            httpd.server_close()
+        except OSError as err:
+            print(str(err), file=sys.stderr)
+
+
+class LiveReload:
+    """
+    Dispatches the change events to the connected clients
+    """
+
+    def __init__(self):
+        self.clients = set()
+        self.lock = threading.Lock()
+
+    def subscribe(self):
+        q = queue.Queue()
+        with self.lock:
+            self.clients.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self.lock:
+            self.clients.discard(q)
+
+    def notify(self, event: str, data: str):
+        with self.lock:
+            for q in self.clients:
+                q.put((event, data))
+
+
+# Sources that a build doesn't publish (see Iraty.process_directory)
+source_exts = ['.yaml', '.yml', '.jinja2']
+
+
+class LazySite:
+    """
+    Maps the request paths to the sources of the website, and renders
+    the pages on first request. The rendered pages are kept in memory
+    until their source (or layout) changes.
+    """
+
+    def __init__(self, ira, source: Path, live: LiveReload = None):
+        self.ira = ira
+        self.source = source
+        self.live = live
+        self.pages = {}
+        self.broken = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+        # Stylesheets served (watched for live reload), and the sources of
+        # the stylesheets published in the output directory
+        self.stylesheets = {}
+        self.published = {
+            ira.asset_dest('lang-selector.css'):
+                assets_root.joinpath('lang-selector.css')
+        }
+
+        themecss = ira.theme_css()
+        if themecss:
+            self.published[ira.asset_dest(themecss.name)] = themecss
+
+    def page_source(self, relp: str):
+        """
+        Returns the source (and its directory relative to the root) of
+        the page relp (a .html path relative to the output root), or None.
+        Pages in a language directory (<lang>/) come from <name>.<lang>.yaml
+        """
+        dirname, name = posixpath.split(relp)
+        basename = name[:-len('.html')]
+        parts = dirname.split('/') if dirname else []
+        candidates = []
+
+        if parts and len(parts[0]) == 2 and i18n.lang_get(parts[0]):
+            candidates.append(('/'.join(parts[1:]),
+                               f'{basename}.{parts[0]}.yaml'))
+
+        candidates += [(dirname, f'{basename}.yaml'),
+                       (dirname, f'{basename}.yml')]
+
+        for rr, fname in candidates:
+            fp = self.source.joinpath(rr, fname)
+
+            if fp.is_file():
+                return fp, rr
+
+        return None, None
+
+    def page_stamp(self, fp: Path, deps=()):
+        """
+        Stamp of the page fp: stamps of its source, layout and of the
+        files it depends on (includes, templates)
+        """
+        layoutp = self.ira.find_closest_layout(fp, self.source)
+        stamps = []
+
+        for dep in deps:
+            try:
+                stamps.append(file_stamp(dep))
+            except OSError:
+                stamps.append(None)
+
+        return (file_stamp(fp), file_stamp(layoutp) if layoutp else None,
+                tuple(stamps))
+
+    def dependencies(self, calls):
+        """
+        Paths of the files included by a page, and of its templates
+        """
+        deps = set()
+
+        for name, args in calls:
+            if name == 'include':
+                deps.add(self.ira.ctx.root_path.joinpath(str(args[0])))
+            elif name == 'template':
+                deps.add(Path(args[0]))
+
+        return sorted(deps)
+
+    def fresh_entry(self, fp: Path):
+        """
+        Returns the cache entry of the page fp if it's up-to-date
+        """
+        entry = self.pages.get(fp)
+
+        if entry is not None and entry[0] == self.page_stamp(fp, entry[4]):
+            return entry
+
+    def page_lock(self, fp: Path):
+        """
+        Returns the lock of the page fp (a page is rendered by one
+        request at a time, different pages are rendered concurrently)
+        """
+        with self.lock:
+            return self.locks.setdefault(fp, threading.Lock())
+
+    def render(self, fp: Path, rr: str, relp: str):
+        """
+        Returns the HTML of the page fp, rendering it if it's not cached
+        or if it changed
+        """
+        entry = self.fresh_entry(fp)
+        self.ira.metrics.cache('page', entry is not None)
+
+        if entry:
+            return entry[1]
+
+        with self.page_lock(fp):
+            # Rendered by another request in the meantime ?
+            entry = self.fresh_entry(fp)
+            if entry:
+                return entry[1]
+
+            entry = self.pages.get(fp)
+
+            # Each request gets its own context (build-constant results
+            # are not kept between requests)
+            ctx = self.ira.ctx.fork()
+            ctx.calls = []
+
+            try:
+                with self.ira.metrics.timed('render'):
+                    dom, _dest = self.ira.render_page(
+                        fp, self.source, rr, self.ira.outdirp.joinpath(rr),
+                        ctx=ctx)
+                    html = self.ira.output_dom(dom).read()
+            except Exception:
+                deps = entry[4] if entry else ()
+                self.broken[fp] = self.page_stamp(fp, deps)
+                raise
+
+            deps = self.dependencies(ctx.calls)
+
+            self.ira.metrics.inc('pages_rendered_total')
+            self.pages[fp] = (self.page_stamp(fp, deps), html, rr, relp, deps)
+
+        return html
+
+    def check(self):
+        """
+        Render again the pages that changed since they were served, and
+        notify the clients of the pages whose output changed (and of the
+        stylesheets that changed)
+        """
+        for fp, (stamp, html, rr, relp, deps) in list(self.pages.items()):
+            try:
+                current = self.page_stamp(fp, deps)
+
+                if current in [stamp, self.broken.get(fp)]:
+                    continue
+
+                if self.render(fp, rr, relp) != html:
+                    self.live.notify('reload', f'/{relp}')
+            except Exception as err:
+                print(f'{fp}: {err}', file=sys.stderr)
+
+        for url, (src, dest, stamp) in list(self.stylesheets.items()):
+            try:
+                current = file_stamp(src)
+                if current == stamp:
+                    continue
+
+                if dest:
+                    self.ira.asset_published(
+                        dest, publish_file(src, dest,
+                                           mode=self.ira.args.asset_mode))
+
+                self.stylesheets[url] = (src, dest, current)
+                self.live.notify('css', url)
+            except OSError as err:
+                print(f'{src}: {err}', file=sys.stderr)
+
+    def watch(self, interval: float = 0.5):
+        """
+        Check for changes every interval seconds (in a thread)
+        """
+        def watcher():
+            while True:
+                time.sleep(interval)
+                self.check()
+
+        threading.Thread(target=watcher, daemon=True).start()
+
+    def served(self, relp: str, fp: Path):
+        """
+        Track the stylesheets that are served (to hot-swap them)
+        """
+        if self.live is None or not relp.endswith('.css'):
+            return
+
+        src, dest = self.published.get(fp, fp), None
+        if fp in self.published:
+            dest = fp
+
+        if f'/{relp}' not in self.stylesheets:
+            self.stylesheets[f'/{relp}'] = (src, dest, file_stamp(src))
+
+    def asset_path(self, relp: str):
+        """
+        Returns the path of the published asset relp (theme CSS, lang
+        selector), or None
+        """
+        fp = self.ira.outdirp.joinpath(relp)
+
+        if fp in self.published:
+            return fp if fp.is_file() else self.published[fp]
+
+    def lookup(self, urlpath: str):
+        """
+        Resolve a request path. Returns ('html', bytes), ('file', Path),
+        ('redirect', url), or (None, None) if there's nothing at this path
+        """
+        parts = [p for p in urlpath.split('/') if p]
+
+        if any(p in ['.', '..'] or p.startswith('.') for p in parts):
+            return None, None
+
+        relp = '/'.join(parts)
+
+        if not parts or urlpath.endswith('/'):
+            relp = posixpath.join(relp, 'index.html')
+
+        if relp.endswith('.html'):
+            fp, rr = self.page_source(relp)
+
+            if fp:
+                return 'html', self.render(fp, rr, relp)
+
+        fp = self.asset_path(relp)
+        if fp:
+            self.served(relp, fp)
+            return 'file', fp
+
+        # The sources come first, the output directory may have stale
+        # copies (from previous builds)
+        for root in [self.source, self.ira.outdirp]:
+            fp = root.joinpath(relp)
+
+            if root == self.source and fp.suffix in source_exts:
+                # Pages, layouts and templates are not published
+                continue
+
+            if fp.is_file():
+                self.served(relp, fp)
+                return 'file', fp
+            elif fp.is_dir() and parts and not urlpath.endswith('/'):
+                return 'redirect', urlpath + '/'
+
+        if parts and len(parts) == 1 and i18n.lang_get(parts[0]) and \
+                not urlpath.endswith('/'):
+            # Language directory
+            return 'redirect', urlpath + '/'
+
+        if relp == 'index.html':
+            # Redirect to the default language
+            pt1 = self.ira.lang_default.pt1
+
+            if self.source.joinpath(f'index.{pt1}.yaml').is_file():
+                return 'redirect', f'/{pt1}/'
+
+        return None, None
+
+
+class LazyRequestHandler(RangeRequestHandler):
+    """
+    Serves the pages of a LazySite (and the assets, from the output
+    directory or from the sources)
+    """
+
+    def do_GET(self):
+        if urlsplit(self.path).path == livereload_path and \
+                self.server.site.live:
+            return self.send_events()
+
+        return super().do_GET()
+
+    def send_events(self):
+        """
+        Stream the change events (server-sent events)
+        """
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.close_connection = True
+
+        live = self.server.site.live
+        q = live.subscribe()
+
+        try:
+            while True:
+                try:
+                    event, data = q.get(timeout=15)
+                    msg = f'event: {event}\ndata: {data}\n\n'
+                except queue.Empty:
+                    msg = ': ping\n\n'
+
+                self.wfile.write(msg.encode())
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            live.unsubscribe(q)
+
+    def send_head(self):
+        self.ranges, self.boundary = None, None
+        urlpath = unquote(urlsplit(self.path).path)
+
+        try:
+            kind, value = self.server.site.lookup(urlpath)
+        except Exception as err:
+            print(f'{urlpath}: {err}', file=sys.stderr)
+            self.send_error(500, str(err))
+            return None
+
+        if kind == 'html':
+            if self.server.site.live:
+                # Inject the live reload client
+                body = value.rsplit(b'</body>', 1)
+                value = body[0] + livereload_script + b'</body>' + \
+                    body[1] if len(body) == 2 else value + livereload_script
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(value)))
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            return io.BytesIO(value)
+        elif kind == 'redirect':
+            self.send_response(301)
+            self.send_header('Location', value)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+        elif kind == 'file':
+            self.filepath = value
+            return super().send_head()
+
+        self.send_error(404, 'File not found')
+        return None
+
+    def translate_path(self, path):
+        return str(self.filepath)
+
+
+def lazy_serve(ira, source: Path, port=8000, live_reload: bool = True):
+    """
+    Serve the website in source via HTTP, rendering the pages on demand.
+    With live_reload, the browsers are notified when pages change.
+    """
+    css_langsel = assets_root.joinpath('lang-selector.css')
+
+    if css_langsel.is_file():
+        dest = ira.asset_dest(css_langsel.name)
+        ira.asset_published(dest, publish_file(css_langsel, dest,
+                                               mode=ira.args.asset_mode))
+
+    try:
+        httpd = HTTPServer(('', port), LazyRequestHandler)
+    except OSError as err:
+        print(str(err), file=sys.stderr)
+        return 1
+
+    httpd.site = LazySite(ira, source,
+                          live=LiveReload() if live_reload else None)
+
+    if live_reload:
+        httpd.site.watch()
+
+    print(f'Serving via HTTP at: http://localhost:{port} (pages are '
+          'rendered on demand)', file=sys.stdout)
+
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+
+    return 0
+
+
+class CarRequestHandler(RangeRequestHandler):
+    """
+    Serves the UnixFS files of a CAR archive by path (from its root).
+    The file bodies are sent from the archive, block by block.
+    """
+
+    def send_head(self):
+        self.ranges, self.boundary = None, None
+        car = self.server.car
+        urlpath = unquote(urlsplit(self.path).path)
+        names = [p for p in urlpath.split('/') if p]
+
+        try:
+            cid, dtype, links = car.resolve(names)
+
+            if dtype == t_directory:
+                if not urlpath.endswith('/'):
+                    self.send_response(301)
+                    self.send_header('Location', urlpath + '/')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return None
+
+                cid, dtype, links = car.resolve(['index.html'], root=cid)
+                names.append('index.html')
+
+            if cid is None:
+                self.send_error(404, 'File not found')
+                return None
+
+            self.segments = car.file_segments(cid)
+        except UnsupportedDag as err:
+            self.send_error(501, str(err))
+            return None
+        except InvalidCar as err:
+            self.send_error(500, str(err))
+            return None
+
+        size = sum(length for _pos, length in self.segments)
+        f = open(str(car.path), 'rb')
+
+        return self.send_body(
+            f, size, self.guess_type(names[-1]),
+            etag=f'"{cid_str(cid)}"',
+            headers={'Cache-Control': 'public, max-age=31536000, immutable'}
+        )
+
+    def sendfile(self, source, offset: int, count: int):
+        # Map the range of the file to the segments of the archive
+        pos = 0
+
+        for segpos, length in self.segments:
+            if count <= 0:
+                break
+
+            if offset < pos + length:
+                start = max(offset - pos, 0)
+                n = min(length - start, count)
+                super().sendfile(source, segpos + start, n)
+                offset += n
+                count -= n
+
+            pos += length
+
+
+def car_serve(path: Path, port=8000):
+    """
+    Serve via HTTP the UnixFS DAG in the CAR file path
+    """
+    try:
+        car = CarArchive(path)
+    except (OSError, InvalidCar) as err:
+        print(str(err), file=sys.stderr)
+        return 1
+
+    if not car.roots:
+        print(f'{path}: no root', file=sys.stderr)
+        return 1
+
+    try:
+        httpd = HTTPServer(('', port), CarRequestHandler)
+    except OSError as err:
+        print(str(err), file=sys.stderr)
+        return 1
+
+    httpd.car = car
+    print(f'Serving {cid_str(car.roots[0])} ({len(car.blocks)} blocks) via '
+          f'HTTP at: http://localhost:{port}', file=sys.stdout)
+
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        car.close()
+
+    return 0
@@ -0,0 +1,272 @@
+"""
+Render service: converts YAML documents to HTML on demand, over a Unix
+or TCP socket, keeping the caches (templates, markdown, resolvers) warm
+between requests.
+
+Requests and responses are JSON objects, one per line:
+
+{"id": 1, "content": "body:\n  p: Hello"}
+{"id": 1, "html": "<!DOCTYPE html>...", "ms": 4.2}
+
+Requests can have *options* (*output*: html, cid or ipfs, ipfs is only
+allowed on Unix sockets):
+
+{"id": 2, "content": "body:\n  p: Hello", "options": {"output": "cid"}}
+{"id": 2, "cid": "bafkrei...", "ms": 3.1}
+"""
+
+import io
+import json
+import os
+import socket
+import socketserver
+import stat
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .unixfs import bytes_cid
+
+
+# Maximum size of a request line
+max_request_size = 16 * 1024 * 1024
+
+output_modes = ['html', 'cid', 'ipfs']
+
+# Options accepted in requests
+request_options = ['output']
+
+
+def default_socket_path():
+    return os.path.join(tempfile.gettempdir(), f'iraty-{os.getuid()}.sock')
+
+
+def stale_socket(path: str):
+    """
+    True if path is a Unix socket that nobody listens on (left by a
+    server that didn't exit cleanly)
+    """
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return False
+    except OSError:
+        return False
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        sock.connect(path)
+    except ConnectionRefusedError:
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+    return False
+
+
+def render_document(ira, source):
+    """
+    Render a document (a path or a StringIO) with a forked build
+    context, returns the HTML (bytes). Raises the rendering errors.
+    """
+    dom, _l, _p = ira.process_file(
+        source,
+        destdir_root=Path('.'),
+        ctx=ira.ctx.fork(),
+        raise_errors=True
+    )
+
+    return ira.output_dom(dom).read()
+
+
+def render_request(ira, req: dict, output: str = 'html', paths=False,
+                   outputs: list = None):
+    """
+    Render the document of a request, with its options. The document is
+    the YAML text in *content*, or if paths is True, the path
+    of a document in *path*. outputs are the allowed outputs (all by
+    default). Returns ('html', HTML) or ('cid', CID).
+    """
+    content = req.get('content')
+    options = req.get('options') or {}
+
+    if not isinstance(options, dict):
+        raise ValueError("'options' must be an object")
+
+    unknown = sorted(set(options) - set(request_options))
+    if unknown:
+        raise ValueError(f"Unknown option(s): {', '.join(unknown)}")
+
+    output = options.get('output', output)
+
+    if output not in output_modes:
+        raise ValueError(f'Invalid output: {output}')
+    elif outputs is not None and output not in outputs:
+        raise ValueError(f'Output not allowed: {output}')
+
+    if isinstance(content, str):
+        source = io.StringIO(content)
+    elif paths and isinstance(req.get('path'), str):
+        source = Path(req['path'])
+
+        if not source.is_file():
+            raise ValueError(f'{source} does not exist')
+    else:
+        raise ValueError("'content' or 'path' is required" if paths else
+                         "'content' must be a string")
+
+    html = render_document(ira, source)
+
+    if output == 'cid':
+        return 'cid', bytes_cid(html)
+    elif output == 'ipfs':
+        cid = ira.ipfs_add(io.BytesIO(html))
+        if not cid:
+            raise ValueError('Could not add the document to IPFS')
+
+        return 'cid', cid
+
+    return 'html', html.decode()
+
+
+class RenderHandler(socketserver.StreamRequestHandler):
+    """
+    Handles the requests of a connection (in order)
+    """
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline(max_request_size + 1)
+
+            if not line:
+                break
+            elif not line.strip():
+                continue
+
+            if len(line) > max_request_size:
+                resp = {'error': 'Request too large'}
+            else:
+                resp = self.server.service.submit(line)
+
+            self.wfile.write(json.dumps(resp).encode() + b'\n')
+            self.wfile.flush()
+
+            if len(line) > max_request_size:
+                break
+
+
+class UnixRenderServer(socketserver.ThreadingMixIn,
+                       socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class TCPRenderServer(socketserver.ThreadingMixIn,
+                      socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class RenderService:
+    """
+    Renders documents with an Iraty object, in a pool of jobs workers.
+    outputs are the outputs the clients can request.
+    """
+
+    def __init__(self, ira, jobs: int = 0, outputs: list = None):
+        self.ira = ira
+        self.outputs = outputs
+        self.pool = ThreadPoolExecutor(
+            max_workers=jobs if jobs else os.cpu_count())
+
+    def render(self, req: dict):
+        return render_request(self.ira, req, outputs=self.outputs)
+
+    def submit(self, line: bytes):
+        """
+        Handle a request line, returns the response
+        """
+        start = time.monotonic()
+        resp = {}
+
+        try:
+            req = json.loads(line)
+            assert isinstance(req, dict), 'Request must be a JSON object'
+
+            resp['id'] = req.get('id')
+
+            key, value = self.pool.submit(self.render, req).result()
+            resp[key] = value
+        except Exception as err:
+            resp['error'] = str(err) if str(err) else type(err).__name__
+            self.ira.metrics.error('request')
+
+        elapsed = time.monotonic() - start
+        resp['ms'] = round(elapsed * 1000, 2)
+
+        self.ira.metrics.observe('request_duration_seconds', elapsed)
+        print(f"Request {resp.get('id')}: {resp['ms']} ms"
+              f"{' (error)' if 'error' in resp else ''}", file=sys.stderr)
+
+        return resp
+
+
+def render_serve(ira, listen: str = None, jobs: int = 0):
+    """
+    Run the render service. listen is a Unix socket path, or host:port
+    to listen on TCP.
+    """
+    listen = listen if listen else default_socket_path()
+    service = RenderService(ira, jobs=jobs)
+
+    created = None
+
+    if '/' not in listen and ':' in listen:
+        # Anyone reaching the port can send requests: no adding to IPFS
+        service.outputs = ['html', 'cid']
+
+        host, port = listen.rsplit(':', 1)
+        server = TCPRenderServer((host, int(port)), RenderHandler)
+    else:
+        if os.path.lexists(listen):
+            if not stale_socket(listen):
+                print(f'{listen} already exists (and is not a stale socket)',
+                      file=sys.stderr)
+                service.pool.shutdown(wait=False)
+                return 1
+
+            os.unlink(listen)
+
+        umask = os.umask(0o077)
+        try:
+            server = UnixRenderServer(listen, RenderHandler)
+        finally:
+            os.umask(umask)
+
+        st = os.stat(listen)
+        created = (st.st_dev, st.st_ino)
+
+    server.service = service
+    print(f'Render service listening on: {listen}', file=sys.stderr)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.pool.shutdown(wait=False)
+
+        try:
+            st = os.stat(listen) if created else None
+        except OSError:
+            st = None
+
+        if st and (st.st_dev, st.st_ino) == created:
+            # Only remove the socket created by this process
+            os.unlink(listen)
+
+    return 0
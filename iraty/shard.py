@@ -0,0 +1,155 @@
+"""
+Sharded builds: the pages of a website are partitioned (by a hash of
+their path) between N builds, each writing its output and a shard
+manifest. The outputs are then combined with merge().
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+from pathlib import Path
+
+from .fsutil import atomic_write
+from .fsutil import file_digest
+from .fsutil import publish_file
+from .fsutil import staging_directory
+from .fsutil import swap_directory
+
+
+manifest_name = '.iraty-shard.json'
+
+
+class ShardError(Exception):
+    pass
+
+
+def parse_shard(spec: str):
+    """
+    Parse a shard spec (i/N, 1 <= i <= N), returns (i, N)
+    """
+    try:
+        index, count = [int(v) for v in spec.split('/')]
+    except ValueError:
+        raise ShardError(f'Invalid shard: {spec} (expected: i/N)')
+
+    if count < 1 or index not in range(1, count + 1):
+        raise ShardError(f'Invalid shard: {spec}')
+
+    return index, count
+
+
+def shard_of(relp: str, count: int):
+    """
+    Returns the shard (1 to count) of the page relp (path of the source
+    relative to the website's root). Only depends on the path.
+    """
+    digest = hashlib.sha256(Path(relp).as_posix().encode()).digest()
+    return int.from_bytes(digest[:8], 'big') % count + 1
+
+
+def write_manifest(outdir: Path, index: int, count: int, outputs,
+                   failures: int = 0):
+    """
+    Write the manifest of a shard: the files it wrote (with their
+    digest) and the directories of its output
+    """
+    files = {}
+
+    for path in sorted(outputs):
+        relp = Path(os.path.relpath(path, str(outdir))).as_posix()
+
+        if os.path.isfile(path) and not relp.startswith('../'):
+            files[relp] = file_digest(Path(path))
+
+    dirs = sorted(
+        Path(os.path.relpath(root, str(outdir))).joinpath(name).as_posix()
+        for root, dnames, _f in os.walk(str(outdir)) for name in dnames
+    )
+
+    atomic_write(outdir.joinpath(manifest_name), json.dumps({
+        'shard': index,
+        'shards': count,
+        'files': files,
+        'dirs': dirs,
+        'failures': failures
+    }, indent=2, sort_keys=True).encode())
+
+
+def load_manifest(shard_dir: Path):
+    path = shard_dir.joinpath(manifest_name)
+
+    try:
+        with open(str(path), 'rt') as fd:
+            return json.load(fd)
+    except (OSError, ValueError) as err:
+        raise ShardError(f'{shard_dir}: cannot load the shard manifest '
+                         f'({err})')
+
+
+def merge(dest: Path, shard_dirs: list, mode: str = 'auto'):
+    """
+    Combine the outputs of the shards of a build into dest (replaced
+    atomically). All the shards must be present, and files written by
+    several shards (shared assets) must be identical.
+
+    Returns 0 on success, 3 if pages failed in some shards.
+    """
+    manifests = {}
+
+    for shard_dir in shard_dirs:
+        manifest = load_manifest(shard_dir)
+        index = manifest['shard']
+
+        if index in manifests:
+            raise ShardError(f'{shard_dir}: shard {index} given twice')
+
+        manifests[index] = (shard_dir, manifest)
+
+    counts = set(m['shards'] for _d, m in manifests.values())
+    if len(counts) != 1:
+        raise ShardError('The shards are from different builds '
+                         f'(shard counts: {sorted(counts)})')
+
+    missing = set(range(1, counts.pop() + 1)) - set(manifests)
+    if missing:
+        raise ShardError(f'Missing shard(s): {sorted(missing)}')
+
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    staging = staging_directory(dest)
+    digests = {}
+    failures = 0
+
+    try:
+        for index in sorted(manifests):
+            shard_dir, manifest = manifests[index]
+            failures += manifest.get('failures', 0)
+
+            for relp in manifest['dirs']:
+                staging.joinpath(relp).mkdir(parents=True, exist_ok=True)
+
+            for relp, digest in manifest['files'].items():
+                if relp in digests:
+                    if digests[relp] != digest:
+                        raise ShardError(f'{relp}: differs between shards')
+                    continue
+
+                src = shard_dir.joinpath(relp)
+                if not src.is_file():
+                    raise ShardError(f'{src}: missing')
+
+                target = staging.joinpath(relp)
+                target.parent.mkdir(parents=True, exist_ok=True)
+                publish_file(src, target, mode=mode)
+                digests[relp] = digest
+
+        swap_directory(staging, dest)
+    except BaseException:
+        shutil.rmtree(str(staging), ignore_errors=True)
+        raise
+
+    print(f'Merged {len(manifests)} shard(s), {len(digests)} files',
+          file=sys.stderr)
+
+    return 3 if failures else 0
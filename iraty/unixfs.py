@@ -0,0 +1,371 @@
+"""
+Local UnixFS DAG builder, producing the same CIDs as go-ipfs/kubo's
+"ipfs add --cid-version=1" with the default settings: fixed-size chunker
+(256 KiB), raw leaves, balanced layout (174 links per node), dag-pb
+nodes and sha2-256 multihashes.
+
+HAMT-sharded directories are not supported (kubo shards directories
+when their node would be larger than 256 KiB).
+"""
+
+import base64
+import hashlib
+import io
+import os
+import stat
+from collections import namedtuple
+from pathlib import Path
+
+from .cache import file_stamp
+
+
+chunk_size = 262144
+max_links = 174
+hamt_sharding_size = 262144
+
+codec_raw = 0x55
+codec_dagpb = 0x70
+mh_sha2_256 = 0x12
+
+# UnixFS data types
+t_raw = 0
+t_directory = 1
+t_file = 2
+t_symlink = 4
+t_hamt_shard = 5
+
+
+# A DAG node: CID (bytes), cumulative DAG size, file size
+Link = namedtuple('Link', ['cid', 'tsize', 'size'])
+
+
+class UnsupportedDag(Exception):
+    pass
+
+
+def varint(n: int):
+    buf = bytearray()
+
+    while True:
+        byte = n & 0x7f
+        n >>= 7
+
+        if n:
+            buf.append(byte | 0x80)
+        else:
+            buf.append(byte)
+            return bytes(buf)
+
+
+def read_varint(buf, offset: int = 0):
+    """
+    Decode a varint, returns the value and the offset of the next byte
+    """
+    value, shift = 0, 0
+
+    while True:
+        byte = buf[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+
+        if not byte & 0x80:
+            return value, offset
+
+        shift += 7
+
+
+def pb_varint(field: int, value: int):
+    return varint(field << 3) + varint(value)
+
+
+def pb_bytes(field: int, data: bytes):
+    return varint((field << 3) | 2) + varint(len(data)) + data
+
+
+def make_cid(codec: int, data: bytes):
+    return b'\x01' + varint(codec) + bytes([mh_sha2_256, 32]) + \
+        hashlib.sha256(data).digest()
+
+
+def cid_str(cid: bytes):
+    return 'b' + base64.b32encode(cid).decode().lower().rstrip('=')
+
+
+def cid_decode(cids: str):
+    if not cids.startswith('b'):
+        raise ValueError(f'Unsupported CID encoding: {cids}')
+
+    data = cids[1:].upper()
+    return base64.b32decode(data + '=' * (-len(data) % 8))
+
+
+def unixfs_data(dtype: int, data: bytes = None, filesize: int = None,
+                blocksizes=()):
+    buf = pb_varint(1, dtype)
+
+    if data is not None:
+        buf += pb_bytes(2, data)
+    if filesize is not None:
+        buf += pb_varint(3, filesize)
+
+    for size in blocksizes:
+        buf += pb_varint(4, size)
+
+    return buf
+
+
+def pb_node(links, data: bytes):
+    """
+    Encode a dag-pb node (links are (cid, name, tsize) tuples)
+    """
+    buf = b''
+
+    for cid, name, tsize in links:
+        link = pb_bytes(1, cid) + pb_bytes(2, name.encode())
+        buf += pb_bytes(2, link + pb_varint(3, tsize))
+
+    return buf + pb_bytes(1, data)
+
+
+def pb_fields(buf, start: int = 0, end: int = None):
+    """
+    Iterate over the fields of a protobuf message in buf[start:end].
+    Yields (field, value): value is an int (varint), or the (start, end)
+    positions in buf of the bytes (length-delimited).
+    """
+    offset = start
+    end = len(buf) if end is None else end
+
+    while offset < end:
+        key, offset = read_varint(buf, offset)
+        field, wtype = key >> 3, key & 7
+
+        if wtype == 0:
+            value, offset = read_varint(buf, offset)
+        elif wtype == 2:
+            length, offset = read_varint(buf, offset)
+            value = (offset, offset + length)
+            offset += length
+        else:
+            raise UnsupportedDag(f'Unsupported protobuf wire type: {wtype}')
+
+        yield field, value
+
+
+def decode_pb_node(buf, start: int = 0, end: int = None):
+    """
+    Decode a dag-pb node. Returns its links ((cid, name, tsize) tuples)
+    and the (start, end) positions of its data (or None)
+    """
+    links, data = [], None
+
+    for field, value in pb_fields(buf, start, end):
+        if field == 1:
+            data = value
+        elif field == 2:
+            cid, name, tsize = None, '', 0
+
+            for lfield, lvalue in pb_fields(buf, *value):
+                if lfield == 1:
+                    cid = bytes(buf[lvalue[0]:lvalue[1]])
+                elif lfield == 2:
+                    name = bytes(buf[lvalue[0]:lvalue[1]]).decode()
+                elif lfield == 3:
+                    tsize = lvalue
+
+            links.append((cid, name, tsize))
+
+    return links, data
+
+
+def decode_unixfs_data(buf, start: int, end: int):
+    """
+    Decode UnixFS data. Returns the type, the (start, end) positions of
+    the file data (or None), and the file size
+    """
+    dtype, data, filesize = None, None, None
+
+    for field, value in pb_fields(buf, start, end):
+        if field == 1:
+            dtype = value
+        elif field == 2:
+            data = value
+        elif field == 3:
+            filesize = value
+
+    return dtype, data, filesize
+
+
+def cid_codec(cid: bytes):
+    """
+    Returns the codec of a (binary) CID
+    """
+    if len(cid) == 34 and cid[0] == mh_sha2_256:
+        # CIDv0
+        return codec_dagpb
+
+    _version, offset = read_varint(cid)
+    return read_varint(cid, offset)[0]
+
+
+class DagBuilder:
+    """
+    Computes the UnixFS DAG of files and directories.
+
+    If a sink is given, it's called with the CID and the data of
+    every block. File and leaf CIDs are cached in the JsonCache passed
+    as cache.
+    """
+
+    def __init__(self, sink=None, cache=None):
+        self.sink = sink
+        self.cache = cache
+
+    def block(self, codec: int, data: bytes):
+        cid = make_cid(codec, data)
+
+        if self.sink:
+            self.sink(cid, data)
+
+        return cid
+
+    def file_node(self, children: list):
+        sizes = [child.size for child in children]
+        data = pb_node(
+            [(child.cid, '', child.tsize) for child in children],
+            unixfs_data(t_file, filesize=sum(sizes), blocksizes=sizes)
+        )
+
+        return Link(self.block(codec_dagpb, data),
+                    len(data) + sum(child.tsize for child in children),
+                    sum(sizes))
+
+    def add_stream(self, fd, leaf_cids: list = None):
+        """
+        Chunk a file object, returns the Link to the root of the file
+        and the list of leaf CIDs. If the leaf CIDs are already known
+        (leaf_cids), the chunks are not hashed again.
+        """
+        leaves = []
+
+        while True:
+            chunk = fd.read(chunk_size)
+
+            if not chunk and leaves:
+                break
+
+            if leaf_cids and len(leaves) < len(leaf_cids):
+                cid = leaf_cids[len(leaves)]
+
+                if self.sink:
+                    self.sink(cid, chunk)
+            else:
+                cid = self.block(codec_raw, chunk)
+
+            leaves.append(Link(cid, len(chunk), len(chunk)))
+
+            if len(chunk) < chunk_size:
+                break
+
+        level = leaves
+        while len(level) > 1:
+            level = [self.file_node(level[idx:idx + max_links])
+                     for idx in range(0, len(level), max_links)]
+
+        return level[0], [leaf.cid for leaf in leaves]
+
+    def add_file(self, path: Path):
+        path = Path(path)
+        key = str(path.resolve())
+        stamp = list(file_stamp(path))
+        entry = self.cache.get(key) if self.cache is not None else None
+
+        if not entry or entry[:2] != stamp:
+            entry = None
+        elif not self.sink:
+            return Link(cid_decode(entry[2]), entry[3], stamp[1])
+
+        leaf_cids = None
+        if entry:
+            # Unchanged file, the blocks are needed but not the hashes
+            leaf_cids = [cid_decode(c) for c in entry[4]] if \
+                len(entry) > 4 else [cid_decode(entry[2])]
+
+        with open(path, 'rb') as fd:
+            link, leaves = self.add_stream(fd, leaf_cids=leaf_cids)
+
+        if self.cache is not None and not entry:
+            value = stamp + [cid_str(link.cid), link.tsize]
+
+            if len(leaves) > 1:
+                value.append([cid_str(c) for c in leaves])
+
+            self.cache.set(key, value)
+
+        return link
+
+    def add_symlink(self, path: Path):
+        data = pb_node([], unixfs_data(t_symlink,
+                                       data=os.fsencode(os.readlink(path))))
+        return Link(self.block(codec_dagpb, data), len(data), 0)
+
+    def add_directory(self, path: Path):
+        links = []
+
+        for entry in sorted(os.scandir(path),
+                            key=lambda e: os.fsencode(e.name)):
+            if entry.name.startswith('.'):
+                # Hidden files are not imported by the node either
+                continue
+
+            mode = entry.stat(follow_symlinks=False).st_mode
+
+            if stat.S_ISLNK(mode):
+                link = self.add_symlink(Path(entry.path))
+            elif stat.S_ISDIR(mode):
+                link = self.add_directory(Path(entry.path))
+            elif stat.S_ISREG(mode):
+                link = self.add_file(Path(entry.path))
+            else:
+                continue
+
+            links.append((link.cid, entry.name, link.tsize))
+
+        estimated = sum(len(name.encode()) + len(cid) for cid, name, t in links)
+        if estimated > hamt_sharding_size:
+            raise UnsupportedDag(f'{path}: directory too large, it would be '
+                                 'HAMT-sharded')
+
+        data = pb_node(links, unixfs_data(t_directory))
+        return Link(self.block(codec_dagpb, data),
+                    len(data) + sum(t for c, n, t in links), 0)
+
+    def add_path(self, path: Path):
+        """
+        Add a file or a directory, returns the Link to its root
+        """
+        path = Path(path)
+
+        if path.is_symlink():
+            return self.add_symlink(path)
+        elif path.is_dir():
+            return self.add_directory(path)
+        else:
+            return self.add_file(path)
+
+
+def path_cid(path: Path, cache=None):
+    """
+    Returns the CID (string) that "ipfs add --cid-version=1 -r" would
+    return for path
+    """
+    builder = DagBuilder(cache=cache)
+    return cid_str(builder.add_path(path).cid)
+
+
+def bytes_cid(data: bytes):
+    """
+    Returns the CID of a file with this contents
+    """
+    link, _leaves = DagBuilder().add_stream(io.BytesIO(data))
+    return cid_str(link.cid)
@@ -0,0 +1,60 @@
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+
+root = Path(__file__).resolve().parent.parent
+
+
+def iraty(tmp_path: Path, *args):
+    env = dict(os.environ,
+               PYTHONPATH=str(root),
+               HOME=str(tmp_path.joinpath('home')),
+               XDG_CACHE_HOME=str(tmp_path.joinpath('cache')),
+               XDG_CONFIG_HOME=str(tmp_path.joinpath('config')))
+
+    return subprocess.run(
+        [sys.executable, '-W', 'ignore', '-c',
+         'from iraty.entrypoint import run; run()'] + list(args),
+        env=env, cwd=str(tmp_path), stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, check=True)
+
+
+def test_fingerprint_css_references(tmp_path):
+    site = tmp_path.joinpath('site')
+    site.joinpath('img').mkdir(parents=True)
+    site.joinpath('css').mkdir()
+
+    site.joinpath('index.yaml').write_text('body:\n  p: Hello\n')
+    site.joinpath('robots.txt').write_text('User-agent: *\n')
+    site.joinpath('img', 'bg.png').write_bytes(b'png')
+    site.joinpath('css', 'base.css').write_text(
+        'h1 { background: url( "../img/bg.png" ) }\n')
+    site.joinpath('css', 'style.css').write_text(
+        '@import "base.css";\n'
+        'body { background: url(../img/bg.png?v=1); }\n'
+        '.a { background: url("data:image/png;base64,AA"); }\n')
+
+    iraty(tmp_path, '--fingerprint', '-o', 'out', 'run', 'site')
+
+    out = tmp_path.joinpath('out')
+    manifest = json.loads(out.joinpath('asset-manifest.json').read_text())
+
+    bg = manifest['img/bg.png']
+    base = manifest['css/base.css']
+    style = manifest['css/style.css']
+
+    assert bg != 'img/bg.png' and out.joinpath(bg).is_file()
+    assert not out.joinpath('img', 'bg.png').exists()
+
+    css = out.joinpath(style).read_text()
+    assert f'@import "{os.path.basename(base)}";' in css
+    assert f'url(../{bg}?v=1)' in css
+    assert 'url("data:image/png;base64,AA")' in css
+    assert f'url( "../{bg}" )' in out.joinpath(base).read_text()
+
+    # Other files keep their name
+    assert 'robots.txt' not in manifest
+    assert out.joinpath('robots.txt').is_file()
@@ -0,0 +1,109 @@
+from pathlib import Path
+
+import pytest
+
+from iraty.car import CarArchive
+from iraty.car import export_car
+from iraty.unixfs import bytes_cid
+from iraty.unixfs import cid_decode
+from iraty.unixfs import cid_str
+from iraty.unixfs import path_cid
+from iraty.unixfs import t_directory
+from iraty.unixfs import t_file
+
+
+# 1 MiB + 4 bytes: 5 chunks
+multichunk = bytes(range(256)) * 4096 + b'tail'
+
+
+@pytest.fixture(autouse=True)
+def cache_home(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path.joinpath('cache')))
+
+
+def site(root: Path):
+    root.joinpath('sub').mkdir(parents=True)
+    root.joinpath('index.html').write_bytes(b'<p>Hello</p>')
+    root.joinpath('sub', 'big.bin').write_bytes(multichunk)
+    root.joinpath('.hidden').write_bytes(b'not imported')
+    return root
+
+
+files = {
+    'empty': b'',
+    'hello': b'hello world',
+    'multichunk': multichunk,
+    # More than 174 chunks (two levels of file nodes)
+    'wide': bytes(262144 * 175 + 1)
+}
+
+
+@pytest.mark.parametrize('name,cid', [
+    ('empty', 'bafkreihdwdcefgh4dqkjv67uzcmw7ojee6xedzdetojuzjevtenxquvyku'),
+    ('hello', 'bafkreifzjut3te2nhyekklss27nh3k72ysco7y32koao5eei66wof36n5e'),
+    ('multichunk',
+     'bafybeicnlce3ms5z56g35fhlkpavvpom37dh4to4m4ghq43j642kaexqyy'),
+    ('wide', 'bafybeicyowx3udu4hzfyo2ekfduhsfhirbv5j2uhcuyz4zh53vrbx2jdfa')
+])
+def test_file_cid(tmp_path, name, cid):
+    data = files[name]
+    assert bytes_cid(data) == cid
+
+    fp = tmp_path.joinpath('file')
+    fp.write_bytes(data)
+    assert path_cid(fp) == cid
+
+
+def test_empty_directory(tmp_path):
+    assert path_cid(tmp_path) == \
+        'bafybeiczsscdsbs7ffqz55asqdf3smv6klcw3gofszvwlyarci47bgf354'
+
+
+def test_directory_links(tmp_path):
+    for idx in range(200):
+        tmp_path.joinpath(f'f{idx:03d}.txt').write_text(f'{idx}\n')
+
+    assert path_cid(tmp_path) == \
+        'bafybeifglfcxwa4qzk6nmk3iq45jchvmxj57hd5dvn5yj4ri57rlzydwhm'
+
+
+def test_hidden_files(tmp_path):
+    root = site(tmp_path.joinpath('site'))
+    cid = path_cid(root)
+
+    root.joinpath('.hidden').unlink()
+    assert path_cid(root) == cid
+
+
+def test_car_roundtrip(tmp_path):
+    root = site(tmp_path.joinpath('site'))
+    dest = tmp_path.joinpath('site.car')
+
+    cid = export_car(root, dest)
+    assert cid == path_cid(root)
+
+    car = CarArchive(dest)
+
+    try:
+        assert car.roots == [cid_decode(cid)]
+
+        rcid, dtype, links = car.resolve([])
+        assert dtype == t_directory
+        assert [name for _c, name, _t in links] == ['index.html', 'sub']
+
+        assert car.resolve(['.hidden']) == (None, None, None)
+        assert car.resolve(['index.html', 'x']) == (None, None, None)
+
+        for names, data in [(['index.html'], b'<p>Hello</p>'),
+                            (['sub', 'big.bin'], multichunk)]:
+            fcid, dtype, _links = car.resolve(names)
+            assert cid_str(fcid) == bytes_cid(data)
+
+            contents = b''.join(car.map[pos:pos + length] for pos, length in
+                                car.file_segments(fcid))
+            assert contents == data
+
+        _c, dtype, links = car.resolve(['sub', 'big.bin'])
+        assert dtype == t_file and len(links) == 5
+    finally:
+        car.close()